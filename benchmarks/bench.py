@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+End-to-end benchmarks of msu.py against a fake store, SSO and snap.
+
+Every run starts msu.py as a new process with an empty cache and a
+snapcraft.cfg holding valid credentials for the fake store, exactly as
+"make-system-user" runs after a login. The scenarios are:
+
+    single          one assertion with the stored credentials
+    single-refresh  one assertion, the stored discharge needs a refresh first
+    single-login    one assertion after an interactive --login
+    batch           a --manifest of --rows users
+
+For each scenario the median, min and max wall time, the time per
+assertion, the assertions per second and the peak RSS of msu.py are
+reported. --save writes them to a baseline file, --compare checks them
+against one and exits with status 1 when a scenario got slower, or
+bigger, by more than --tolerance.
+
+    python3 benchmarks/bench.py --save baseline.json
+    python3 benchmarks/bench.py --compare baseline.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import fakestore
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+MSU = os.path.join(ROOT, 'launchers', 'bin', 'msu.py')
+SRC = os.path.join(ROOT, 'src')
+
+SCENARIOS = ['single', 'single-refresh', 'single-login', 'batch']
+SSH_KEY = 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQCbench bench@example.com'
+
+# (key, better when higher) of the results compared with a baseline
+COMPARED = [('median_s', False), ('peak_rss_kb', False), ('assertions_per_s', True)]
+
+
+def parseargs():
+    parser = argparse.ArgumentParser(description='Benchmark msu.py against a fake store, SSO and snap.')
+    parser.add_argument('--scenario', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--runs', type=int, default=5,
+        help='Runs of each scenario: default 5.')
+    parser.add_argument('--rows', type=int, default=50,
+        help='Users in the manifest of the batch scenario: default 50.')
+    parser.add_argument('--store-latency', type=float, default=0.05,
+        help='Seconds the fake store and SSO wait before each response: default 0.05.')
+    parser.add_argument('--snap-latency', type=float, default=0.02,
+        help='Seconds the fake "snap keys" and "snap known" wait: default 0.02.')
+    parser.add_argument('--sign-latency', type=float, default=0.02,
+        help='Seconds the fake "snap sign" waits: default 0.02.')
+    parser.add_argument('--save', metavar='FILE',
+        help='Write the results to FILE as a baseline.')
+    parser.add_argument('--compare', metavar='FILE',
+        help='Compare the results with the baseline in FILE.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+        help='Allowed regression against the baseline, as a fraction: default 0.1.')
+    parser.add_argument('--json', action='store_true',
+        help='Print the results as JSON instead of a table.')
+    return parser.parse_args()
+
+
+def runMsu(argv, env, cwd, stdin=b''):
+    """Run msu.py and return (seconds, peak RSS in KiB, returncode, output)."""
+    start = time.monotonic()
+    # a new session has no controlling terminal, so getpass reads stdin
+    proc = subprocess.Popen([sys.executable, MSU] + argv, env=env, cwd=cwd,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            start_new_session=True)
+    proc.stdin.write(stdin)
+    proc.stdin.close()
+    output = proc.stdout.read()
+    proc.stdout.close()
+    # wait4() instead of proc.wait() to get the peak RSS of this one process
+    _, status, usage = os.wait4(proc.pid, 0)
+    seconds = time.monotonic() - start
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    return seconds, usage.ru_maxrss, proc.returncode, output.decode('utf-8', 'replace')
+
+
+def writeManifest(path, rows):
+    with open(path, 'w') as f:
+        f.write('username,email,ssh-keys,serials\n')
+        for i in range(rows):
+            f.write('user{0},user{0}@example.com,{1},bench-serial-{0}\n'.format(i, SSH_KEY))
+
+
+class Bench:
+    def __init__(self, args, store):
+        self.args = args
+        self.store = store
+
+    def environ(self, home):
+        env = dict(os.environ)
+        env.update(self.store.environ())
+        env.update({
+            'PATH': os.path.join(HERE, 'bin') + os.pathsep + env.get('PATH', ''),
+            'PYTHONPATH': SRC,
+            'HOME': home,
+            'XDG_CONFIG_HOME': os.path.join(home, 'config'),
+            'XDG_CACHE_HOME': os.path.join(home, 'cache'),
+            'SNAP_GNUPG_HOME': os.path.join(home, 'gnupg'),
+            'FAKE_SNAP_KEY': fakestore.KEY_NAME,
+            'FAKE_SNAP_FINGERPRINT': fakestore.KEY_FINGERPRINT,
+            'FAKE_SNAP_LATENCY': str(self.args.snap_latency),
+            'FAKE_SNAP_SIGN_LATENCY': str(self.args.sign_latency),
+        })
+        return env
+
+    def prepare(self, home, stale=False):
+        """Create an empty home with stored credentials for the fake store."""
+        for name in ('config/snapcraft', 'cache', 'gnupg', 'out'):
+            os.makedirs(os.path.join(home, name))
+        with open(os.path.join(home, 'config', 'snapcraft', 'snapcraft.cfg'), 'w') as f:
+            f.write(self.store.credentials(stale=stale))
+
+    def once(self, scenario):
+        """Run scenario once and return (seconds, peak RSS, assertions)."""
+        home = tempfile.mkdtemp(prefix='msu-bench-')
+        try:
+            self.prepare(home, stale=scenario == 'single-refresh')
+            argv = ['-b', fakestore.ACCOUNT_ID, '-m', 'bench-model', '-k', fakestore.KEY_NAME]
+            stdin = b''
+            assertions = 1
+            if scenario == 'batch':
+                manifest = os.path.join(home, 'manifest.csv')
+                writeManifest(manifest, self.args.rows)
+                argv += ['--manifest', manifest, '--output-dir', os.path.join(home, 'out')]
+                assertions = self.args.rows
+            else:
+                argv += ['-u', 'bench', '-e', 'bench@example.com', '-s', SSH_KEY]
+            if scenario == 'single-login':
+                argv.append('--login')
+                stdin = b'bench@example.com\nbench password\n\n'
+            seconds, rss, status, output = runMsu(argv, self.environ(home), os.path.join(home, 'out'), stdin)
+            if status != 0:
+                raise RuntimeError('{} failed with status {}:\n{}'.format(scenario, status, output))
+            return seconds, rss, assertions
+        finally:
+            shutil.rmtree(home, ignore_errors=True)
+
+    def run(self, scenario):
+        times = []
+        rss = []
+        for _ in range(self.args.runs):
+            seconds, peak, assertions = self.once(scenario)
+            times.append(seconds)
+            rss.append(peak)
+        median = statistics.median(times)
+        return {
+            'runs': len(times),
+            'assertions': assertions,
+            'median_s': median,
+            'min_s': min(times),
+            'max_s': max(times),
+            'per_assertion_s': median / assertions,
+            'assertions_per_s': assertions / median,
+            'peak_rss_kb': max(rss),
+        }
+
+
+def compare(results, baseline, tolerance):
+    """Return a message for every result that regressed against the baseline."""
+    regressions = []
+    for scenario, result in results.items():
+        old = baseline.get('results', {}).get(scenario)
+        if old is None:
+            continue
+        for key, higherIsBetter in COMPARED:
+            if not old.get(key):
+                continue
+            change = (result[key] - old[key]) / old[key]
+            if (-change if higherIsBetter else change) > tolerance:
+                regressions.append('{}: {} {:.4g} -> {:.4g} ({:+.1%})'.format(scenario, key, old[key], result[key], change))
+    return regressions
+
+
+def printTable(results):
+    print('{:<15} {:>5} {:>10} {:>10} {:>10} {:>13} {:>12} {:>12}'.format(
+        'scenario', 'runs', 'median s', 'min s', 'max s', 's/assertion', 'assertions/s', 'peak RSS KiB'))
+    for scenario, r in results.items():
+        print('{:<15} {:>5} {:>10.3f} {:>10.3f} {:>10.3f} {:>13.4f} {:>12.1f} {:>12}'.format(
+            scenario, r['runs'], r['median_s'], r['min_s'], r['max_s'], r['per_assertion_s'], r['assertions_per_s'], r['peak_rss_kb']))
+
+
+def main():
+    args = parseargs()
+    with fakestore.FakeStore(latency=args.store_latency) as store:
+        bench = Bench(args, store)
+        results = {scenario: bench.run(scenario) for scenario in args.scenario}
+        requests = dict(store.requests)
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'settings': {
+            'rows': args.rows,
+            'store_latency': args.store_latency,
+            'snap_latency': args.snap_latency,
+            'sign_latency': args.sign_latency,
+        },
+        'results': results,
+        'store_requests': requests,
+    }
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        printTable(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('Baseline written to {}.'.format(args.save))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('settings') != report['settings']:
+            print('Warning: the baseline was measured with other settings: {}'.format(baseline.get('settings')))
+        regressions = compare(results, baseline, args.tolerance)
+        for message in regressions:
+            print('Regression: ' + message)
+        if regressions:
+            sys.exit(1)
+        print('No regressions against {}.'.format(args.compare))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,366 @@
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Local stand-ins for the store and Ubuntu SSO endpoints make-system-user uses.
+
+By default one HTTP server answers both, so UBUNTU_ONE_SSO_URL and
+STORE_DASHBOARD_URL are both set to FakeStore.url; with ssoPort the SSO
+endpoints get a server of their own at FakeStore.ssoUrl:
+
+    POST /dev/api/acl/              a root macaroon with an SSO caveat
+    POST /api/v2/tokens/discharge   a discharge macaroon for any email and password
+    POST /api/v2/tokens/refresh     a fresh discharge macaroon
+    GET  /dev/api/account           the account, or a needs_refresh 401 when the
+                                    discharge was made with stale=True
+
+The macaroons are real pymacaroons objects, so the client code handling them
+runs exactly as it does against the store.
+
+Faults makes the responses misbehave: latency drawn from a distribution,
+bursts of 503s, 429 rate limiting, needs_refresh responses and connection
+resets.
+"""
+
+import collections
+import json
+import random
+import socket
+import struct
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import pymacaroons
+
+ACCOUNT_ID = 'benchaccount'
+KEY_NAME = 'benchkey'
+KEY_FINGERPRINT = 'bench' + '0' * 59
+STALE_CAVEAT = 'bench-stale = 1'
+# as Ubuntu SSO writes it: HOST|expires|TIME
+EXPIRES_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+_ROOT_KEY = 'bench root key'
+_DISCHARGE_KEY = 'bench discharge key'
+_CAVEAT_ID = 'bench-caveat'
+
+
+def _authMacaroons(header):
+    """Return the (root, discharge) macaroons of a "Macaroon root=..., discharge=..." header."""
+    if not header or not header.startswith('Macaroon '):
+        return None, None
+    fields = dict(part.strip().split('=', 1) for part in header[len('Macaroon '):].split(','))
+    try:
+        return (pymacaroons.Macaroon.deserialize(fields['root']),
+                pymacaroons.Macaroon.deserialize(fields['discharge']))
+    except Exception:
+        return None, None
+
+
+class Latency:
+    """A distribution of response delays in seconds.
+
+    Specs are "fixed:S", "uniform:LOW,HIGH", "normal:MEAN,STDDEV",
+    "exponential:MEAN" and "lognormal:MEDIAN,SIGMA"; a plain number is fixed.
+    """
+
+    KINDS = {
+        'fixed': lambda rng, s: s,
+        'uniform': lambda rng, low, high: rng.uniform(low, high),
+        'normal': lambda rng, mean, stddev: rng.gauss(mean, stddev),
+        'exponential': lambda rng, mean: rng.expovariate(1.0 / mean) if mean > 0 else 0,
+        'lognormal': lambda rng, median, sigma: median * rng.lognormvariate(0, sigma),
+    }
+
+    def __init__(self, kind='fixed', *params):
+        if kind not in self.KINDS:
+            raise ValueError('unknown latency distribution {!r}'.format(kind))
+        self.kind = kind
+        self.params = params
+
+    @classmethod
+    def parse(cls, spec):
+        if isinstance(spec, Latency):
+            return spec
+        if isinstance(spec, (int, float)):
+            return cls('fixed', float(spec))
+        kind, _, params = spec.partition(':')
+        if not params:
+            return cls('fixed', float(kind))
+        return cls(kind, *(float(p) for p in params.split(',')))
+
+    def sample(self, rng=random):
+        return max(0.0, self.KINDS[self.kind](rng, *self.params))
+
+    def __str__(self):
+        return '{}:{}'.format(self.kind, ','.join('{:g}'.format(p) for p in self.params))
+
+
+class Faults:
+    """What goes wrong with the responses, and how often.
+
+    :param burst_rate: probability that a request starts a burst of 503s
+    :param burst_length: responses in each burst of 503s
+    :param rate_limit: requests per second answered before 429s, 0 for no limit
+    :param needs_refresh: probability that an authorized account request
+                          gets a needs_refresh 401
+    :param discharge_ttl: seconds after which a discharge expires and needs a
+                          refresh, 0 for never; the discharge states its
+                          expiry in a caveat, as Ubuntu SSO's do
+    :param reset: probability that the connection is reset instead of answered
+    :param paths: the paths faults apply to, None for all
+    """
+
+    def __init__(self, burst_rate=0.0, burst_length=5, rate_limit=0.0, needs_refresh=0.0,
+                 discharge_ttl=0.0, reset=0.0, paths=None, seed=None):
+        self.burst_rate = burst_rate
+        self.burst_length = burst_length
+        self.rate_limit = rate_limit
+        self.needs_refresh = needs_refresh
+        self.discharge_ttl = discharge_ttl
+        self.reset = reset
+        self.paths = set(paths) if paths else None
+        self.rng = random.Random(seed)
+        self._burst = 0
+        self._tokens = rate_limit
+        self._refilled = time.monotonic()
+        self._lock = threading.Lock()
+
+    def applies(self, path):
+        return self.paths is None or path in self.paths
+
+    def pick(self, path):
+        """Return the fault for one request: None, 'reset', 503 or 429."""
+        if not self.applies(path):
+            return None
+        with self._lock:
+            if self.reset and self.rng.random() < self.reset:
+                return 'reset'
+            if self._burst == 0 and self.burst_rate and self.rng.random() < self.burst_rate:
+                self._burst = self.burst_length
+            if self._burst > 0:
+                self._burst -= 1
+                return 503
+            if self.rate_limit:
+                now = time.monotonic()
+                self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled) * self.rate_limit)
+                self._refilled = now
+                if self._tokens < 1:
+                    return 429
+                self._tokens -= 1
+        return None
+
+    def refreshNeeded(self, path):
+        if not self.needs_refresh or not self.applies(path):
+            return False
+        with self._lock:
+            return self.rng.random() < self.needs_refresh
+
+
+class _Reset(Exception):
+    pass
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except _Reset:
+            pass
+
+    def _reset(self):
+        # closing with a zero linger time sends a RST instead of a FIN
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.close_connection = True
+        raise _Reset()
+
+    def _reply(self, status, body, headers=()):
+        self.server.store.count(self.command, urlparse(self.path).path, status)
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length) if length else b''
+        try:
+            return json.loads(data.decode('utf-8')) if data else {}
+        except ValueError:
+            return {}
+
+    def _handle(self, method):
+        store = self.server.store
+        path = urlparse(self.path).path
+        body = self._body()
+        store.wait()
+        fault = store.faults.pick(path)
+        if fault == 'reset':
+            store.count(method, path, 'reset')
+            self._reset()
+        if fault == 503:
+            self._reply(503, {'error_list': [{'code': 'service-unavailable', 'message': 'injected burst'}]})
+            return
+        if fault == 429:
+            self._reply(429, {'error_list': [{'code': 'too-many-requests', 'message': 'rate limited'}]},
+                        [('Retry-After', '1')])
+            return
+        route = store.routes.get((method, path))
+        if route is None:
+            self._reply(404, {'error_list': [{'code': 'not-found', 'message': path}]})
+            return
+        self._reply(*route(self, body))
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+class FakeStore:
+    """The store and SSO endpoints on 127.0.0.1, answering after a latency.
+
+    latency is a number of seconds or a Latency; faults is a Faults.
+    """
+
+    def __init__(self, latency=0.0, port=0, faults=None, ssoPort=None, host='127.0.0.1'):
+        self.latency = Latency.parse(latency)
+        self.faults = faults if faults is not None else Faults()
+        self.requests = collections.Counter()
+        self.responses = collections.Counter()
+        self._lock = threading.Lock()
+        self.servers = [self._server(host, port)]
+        self.url = 'http://{}:{}/'.format(host, self.servers[0].server_address[1])
+        if ssoPort is not None and ssoPort != port:
+            self.servers.append(self._server(host, ssoPort))
+            self.ssoUrl = 'http://{}:{}/'.format(host, self.servers[1].server_address[1])
+        else:
+            self.ssoUrl = self.url
+        self.ssoLocation = urlparse(self.ssoUrl).netloc
+        self.routes = {
+            ('POST', '/dev/api/acl/'): self.acl,
+            ('POST', '/api/v2/tokens/discharge'): self.discharge,
+            ('POST', '/api/v2/tokens/refresh'): self.refresh,
+            ('GET', '/dev/api/account'): self.account,
+        }
+
+    def _server(self, host, port):
+        server = ThreadingHTTPServer((host, port), _Handler)
+        server.daemon_threads = True
+        # hundreds of clients connect at once
+        server.request_queue_size = 1024
+        server.store = self
+        return server
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def count(self, method, path, status):
+        endpoint = '{} {}'.format(method, path)
+        with self._lock:
+            self.requests[endpoint] += 1
+            self.responses['{} {}'.format(endpoint, status)] += 1
+
+    def wait(self):
+        delay = self.latency.sample(self.faults.rng)
+        if delay > 0:
+            time.sleep(delay)
+
+    def environ(self):
+        """Return the environment variables pointing make-system-user at this store."""
+        return {'UBUNTU_ONE_SSO_URL': self.ssoUrl, 'STORE_DASHBOARD_URL': self.url}
+
+    # macaroons
+
+    def rootMacaroon(self):
+        root = pymacaroons.Macaroon(location='bench-store', identifier='root', key=_ROOT_KEY)
+        root.add_third_party_caveat(self.ssoLocation, _DISCHARGE_KEY, _CAVEAT_ID)
+        return root.serialize()
+
+    def dischargeMacaroon(self, stale=False):
+        discharge = pymacaroons.Macaroon(location=self.ssoLocation, identifier=_CAVEAT_ID, key=_DISCHARGE_KEY)
+        if self.faults.discharge_ttl:
+            expires = datetime.utcnow() + timedelta(seconds=self.faults.discharge_ttl)
+            discharge.add_first_party_caveat('{}|expires|{}'.format(self.ssoLocation, expires.strftime(EXPIRES_FORMAT)))
+        if stale:
+            discharge.add_first_party_caveat(STALE_CAVEAT)
+        return discharge.serialize()
+
+    def _expired(self, discharge):
+        for caveat in discharge.caveats:
+            caveat_id = caveat.caveat_id
+            if caveat_id == STALE_CAVEAT:
+                return True
+            parts = caveat_id.split('|')
+            if len(parts) == 3 and parts[1] == 'expires':
+                if datetime.utcnow() >= datetime.strptime(parts[2], EXPIRES_FORMAT):
+                    return True
+        return False
+
+    def credentials(self, stale=False):
+        """Return a snapcraft.cfg as a successful login against this store leaves it."""
+        return '[{}]\nmacaroon = {}\nunbound_discharge = {}\nemail = bench@example.com\n\n'.format(
+            self.ssoLocation, self.rootMacaroon(), self.dischargeMacaroon(stale))
+
+    # endpoints, each returns (status, body[, headers])
+
+    def acl(self, handler, body):
+        return 200, {'macaroon': self.rootMacaroon()}
+
+    def discharge(self, handler, body):
+        if not body.get('email') or not body.get('password') or body.get('caveat_id') != _CAVEAT_ID:
+            return 401, {'error_list': [{'code': 'invalid-credentials', 'message': 'bad login'}]}
+        return 200, {'discharge_macaroon': self.dischargeMacaroon()}
+
+    def refresh(self, handler, body):
+        if not body.get('discharge_macaroon'):
+            return 400, {'error_list': [{'code': 'invalid-data', 'message': 'no discharge'}]}
+        return 200, {'discharge_macaroon': self.dischargeMacaroon()}
+
+    def account(self, handler, body):
+        root, discharge = _authMacaroons(handler.headers.get('Authorization'))
+        if root is None:
+            return 401, {'error_list': [{'code': 'invalid-credentials', 'message': 'no macaroon'}]}
+        if self._expired(discharge) or self.faults.refreshNeeded('/dev/api/account'):
+            return 401, {'error_list': []}, [('WWW-Authenticate', 'Macaroon needs_refresh=1')]
+        return 200, {
+            'account_id': ACCOUNT_ID,
+            'username': 'bench',
+            'account_keys': [{'name': KEY_NAME, 'public-key-sha3-384': KEY_FINGERPRINT}],
+        }
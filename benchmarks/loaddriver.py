@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Load test the store clients against the simulator.
+
+--clients store clients each fetch the account --requests times, all at
+once. In "threads" mode every client is an UbuntuOneAuthClient in its own
+thread; in "processes" mode each one runs in its own process, as parallel
+make-system-user runs do; in "async" mode one AsyncUbuntuOneAuthClient
+runs --clients requests concurrently. All clients share one
+snapcraft.cfg, so a discharge refresh by one is seen by the others as it
+would be on a real machine.
+
+--stale starts them all with a discharge that needs a refresh, a refresh
+storm: however many clients there are, the simulator should answer one
+refresh request.
+
+The simulator is started in this process with the fault options of
+simulator.py, unless --external uses the one UBUNTU_ONE_SSO_URL and
+STORE_DASHBOARD_URL point at (started with --credentials FILE, passed
+here as --credentials FILE).
+
+    python3 benchmarks/loaddriver.py --clients 300 --requests 5 \\
+        --latency exponential:0.05 --burst-rate 0.005 --discharge-ttl 2
+    python3 benchmarks/loaddriver.py --mode processes --clients 64 \
+        --requests 1 --stale --latency 0.05
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urljoin
+
+import simulator
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'src'))
+
+
+def parseargs():
+    parser = argparse.ArgumentParser(description='Load test the store clients against the simulator.')
+    parser.add_argument('--clients', type=int, default=100,
+        help='Concurrent clients: default 100.')
+    parser.add_argument('--requests', type=int, default=5,
+        help='Account requests per client: default 5.')
+    parser.add_argument('--mode', choices=['threads', 'processes', 'async'], default='threads')
+    parser.add_argument('--stale', action='store_true',
+        help='Start with a discharge that needs a refresh. Not with --external.')
+    parser.add_argument('--external', action='store_true',
+        help='Use the simulator that UBUNTU_ONE_SSO_URL and STORE_DASHBOARD_URL point at.')
+    parser.add_argument('--credentials', metavar='FILE',
+        help='The snapcraft.cfg written by "simulator.py --credentials", required with --external.')
+    parser.add_argument('--json', action='store_true',
+        help='Print the report as JSON.')
+    simulator.addFaultArguments(parser)
+    args = parser.parse_args()
+    if args.external and not args.credentials:
+        parser.error('--external requires --credentials')
+    if args.external and args.stale:
+        parser.error('--stale cannot be used with --external')
+    return args
+
+
+class Outcomes:
+    """Outcomes and latencies of the account requests, from all clients."""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def record(self, outcome, seconds):
+        with self._lock:
+            self.counts[outcome] += 1
+            self.latencies.append(seconds)
+
+
+def _outcome(response):
+    return str(response.status_code)
+
+
+def runThreads(args, accountUrl, outcomes):
+    import http_clients
+    from http_clients import RequestMetrics
+
+    metrics = RequestMetrics()
+    start = threading.Barrier(args.clients)
+
+    def client():
+        authClient = http_clients.UbuntuOneAuthClient()
+        authClient.metrics = metrics
+        start.wait()
+        for _ in range(args.requests):
+            t = time.monotonic()
+            try:
+                outcome = _outcome(authClient.request('GET', accountUrl, headers={'Accept': 'application/json'}))
+            except Exception as e:
+                outcome = type(e).__name__
+            outcomes.record(outcome, time.monotonic() - t)
+
+    threads = [threading.Thread(target=client) for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return metrics.snapshot()
+
+
+def _processClient(requests, accountUrl, start, results):
+    import http_clients
+
+    authClient = http_clients.UbuntuOneAuthClient()
+    start.wait()
+    for _ in range(requests):
+        t = time.monotonic()
+        try:
+            outcome = _outcome(authClient.request('GET', accountUrl, headers={'Accept': 'application/json'}))
+        except Exception as e:
+            outcome = type(e).__name__
+        results.put((outcome, time.monotonic() - t))
+
+
+def runProcesses(args, accountUrl, outcomes):
+    context = multiprocessing.get_context('fork')
+    start = context.Barrier(args.clients)
+    results = context.Queue()
+    processes = [context.Process(target=_processClient, args=(args.requests, accountUrl, start, results))
+                 for _ in range(args.clients)]
+    for process in processes:
+        process.start()
+    for _ in range(args.clients * args.requests):
+        outcomes.record(*results.get())
+    for process in processes:
+        process.join()
+    # the metrics stay in the client processes
+    return None
+
+
+def runAsync(args, accountUrl, outcomes):
+    import http_clients
+
+    async def run():
+        async with http_clients.AsyncUbuntuOneAuthClient(pool_size=args.clients) as authClient:
+            async def one():
+                t = time.monotonic()
+                try:
+                    outcome = _outcome(await authClient.request('GET', accountUrl, headers={'Accept': 'application/json'}))
+                except Exception as e:
+                    outcome = type(e).__name__
+                outcomes.record(outcome, time.monotonic() - t)
+
+            async def client():
+                for _ in range(args.requests):
+                    await one()
+
+            await asyncio.gather(*(client() for _ in range(args.clients)))
+            return authClient.metrics.snapshot()
+
+    return asyncio.run(run())
+
+
+def report(args, seconds, outcomes, metrics, store):
+    from http_clients import percentile
+
+    latencies = sorted(outcomes.latencies)
+
+    result = {
+        'clients': args.clients,
+        'requests': len(latencies),
+        'seconds': seconds,
+        'requests_per_second': len(latencies) / seconds if seconds > 0 else 0,
+        'outcomes': dict(outcomes.counts),
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_p99': percentile(latencies, 99),
+        'client_metrics': metrics,
+    }
+    if store is not None:
+        result['simulator_responses'] = dict(store.responses)
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+        return
+    print('{} clients, {} requests in {:.2f} s ({:.1f}/s)'.format(
+        args.clients, result['requests'], seconds, result['requests_per_second']))
+    print('latency p50 {:.3f} s, p95 {:.3f} s, p99 {:.3f} s'.format(
+        result['latency_p50'], result['latency_p95'], result['latency_p99']))
+    print('outcomes:')
+    for outcome, count in sorted(outcomes.counts.items()):
+        print('  {:<28} {:>7}'.format(outcome, count))
+    if store is not None:
+        print('simulator responses:')
+        for response, count in sorted(store.responses.items()):
+            print('  {:<40} {:>7}'.format(response, count))
+
+
+def main():
+    args = parseargs()
+    home = tempfile.mkdtemp(prefix='msu-load-')
+    store = None
+    try:
+        if not args.external:
+            store = simulator.storeFromArgs(args)
+            store.start()
+            os.environ.update(store.environ())
+        os.makedirs(os.path.join(home, 'snapcraft'))
+        config = os.path.join(home, 'snapcraft', 'snapcraft.cfg')
+        if store is not None:
+            with open(config, 'w') as f:
+                f.write(store.credentials(stale=args.stale))
+        else:
+            shutil.copy(args.credentials, config)
+        # before http_clients is imported, xdg reads it once
+        os.environ['XDG_CONFIG_HOME'] = home
+
+        accountUrl = urljoin(os.environ['STORE_DASHBOARD_URL'], '/dev/api/account')
+        outcomes = Outcomes()
+        start = time.monotonic()
+        if args.mode == 'threads':
+            metrics = runThreads(args, accountUrl, outcomes)
+        elif args.mode == 'processes':
+            metrics = runProcesses(args, accountUrl, outcomes)
+        else:
+            metrics = runAsync(args, accountUrl, outcomes)
+        report(args, time.monotonic() - start, outcomes, metrics, store)
+    finally:
+        if store is not None:
+            store.stop()
+        shutil.rmtree(home, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Run the fake store and SSO with injected faults until interrupted.
+
+The servers listen on the ports of STORE_DASHBOARD_URL and
+UBUNTU_ONE_SSO_URL when those point at localhost, so clients already
+configured with them talk to the simulator; otherwise free ports are
+picked and the variables to export are printed. With --credentials FILE
+a snapcraft.cfg logged in to the simulator is written to FILE.
+
+    python3 benchmarks/simulator.py --latency lognormal:0.05,0.5 \\
+        --burst-rate 0.01 --burst-length 10 --rate-limit 200 --reset 0.001
+"""
+
+import argparse
+import json
+import os
+import signal
+import sys
+from urllib.parse import urlparse
+
+import fakestore
+
+
+def _localPort(name):
+    """Return the port of the environment variable's URL if it points at this machine."""
+    url = urlparse(os.environ.get(name, ''))
+    if url.hostname in ('127.0.0.1', 'localhost') and url.port:
+        return url.port
+    return None
+
+
+def addFaultArguments(parser):
+    faults = parser.add_argument_group('Faults')
+    faults.add_argument('--latency', default='0',
+        help='Response delay: seconds, or fixed:S, uniform:LOW,HIGH, normal:MEAN,STDDEV, exponential:MEAN or lognormal:MEDIAN,SIGMA. Default 0.')
+    faults.add_argument('--burst-rate', type=float, default=0.0,
+        help='Probability that a request starts a burst of 503 responses.')
+    faults.add_argument('--burst-length', type=int, default=5,
+        help='Responses in each burst of 503s: default 5.')
+    faults.add_argument('--rate-limit', type=float, default=0.0,
+        help='Requests per second answered before 429 responses, 0 (default) for no limit.')
+    faults.add_argument('--needs-refresh', type=float, default=0.0,
+        help='Probability that an account request gets a "Macaroon needs_refresh=1" 401.')
+    faults.add_argument('--discharge-ttl', type=float, default=0.0,
+        help='Seconds after which discharges need a refresh, 0 (default) for never.')
+    faults.add_argument('--reset', type=float, default=0.0,
+        help='Probability that a connection is reset instead of answered.')
+    faults.add_argument('--fault-path', action='append', dest='fault_paths',
+        help='Only inject faults into requests for this path, for example /dev/api/account. May be repeated.')
+    faults.add_argument('--seed', type=int,
+        help='Seed of the fault and latency random numbers, for repeatable runs.')
+
+
+def storeFromArgs(args, port=0, ssoPort=None):
+    faults = fakestore.Faults(
+        burst_rate=args.burst_rate,
+        burst_length=args.burst_length,
+        rate_limit=args.rate_limit,
+        needs_refresh=args.needs_refresh,
+        discharge_ttl=args.discharge_ttl,
+        reset=args.reset,
+        paths=args.fault_paths,
+        seed=args.seed,
+    )
+    return fakestore.FakeStore(latency=fakestore.Latency.parse(args.latency), port=port, faults=faults, ssoPort=ssoPort)
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a fake store and SSO with injected faults.')
+    parser.add_argument('--credentials', metavar='FILE',
+        help='Write a snapcraft.cfg with credentials for the simulator to FILE.')
+    addFaultArguments(parser)
+    args = parser.parse_args()
+
+    try:
+        store = storeFromArgs(args, _localPort('STORE_DASHBOARD_URL') or 0, _localPort('UBUNTU_ONE_SSO_URL'))
+    except ValueError as e:
+        print('Error: {}'.format(e))
+        sys.exit(1)
+    if args.credentials:
+        with open(args.credentials, 'w') as f:
+            f.write(store.credentials())
+
+    signal.signal(signal.SIGTERM, _interrupt)
+    with store:
+        for name, value in sorted(store.environ().items()):
+            print('export {}={}'.format(name, value))
+        print('Latency {}. Press Ctrl-C to stop.'.format(store.latency))
+        sys.stdout.flush()
+        try:
+            signal.pause()
+        except KeyboardInterrupt:
+            pass
+    print(json.dumps({'requests': store.requests, 'responses': store.responses}, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Startup time of msu.py, run as launch.sh runs it, up to --help and to an
+argument error.
+
+Tools call make-system-user in tight loops, so both cases must stay well
+under --target-ms (default 50). The interpreter alone is measured too, as
+the floor. The script also checks that none of the modules only needed
+once the network phases start are imported, and exits with status 1 when
+a case is over the target or imports one of them.
+
+    python3 benchmarks/startup.py --runs 30
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+BIN = os.path.join(ROOT, 'launchers', 'bin')
+
+PYTHON = [sys.executable, '-s']
+# as launch.sh runs it
+MSU = ['-c', 'import sys; sys.path[0] = sys.argv.pop(1); import msu; sys.exit(msu.main(sys.argv))', BIN]
+
+CASES = [
+    ('interpreter', ['-c', 'pass']),
+    ('--help', MSU + ['--help']),
+    ('argument error', MSU + ['-b', 'brand', '-m', 'model', '-k', 'key', '-u', 'user', '-e', 'user@example.com']),
+    ('bad until', MSU + ['-b', 'brand', '-m', 'model', '-k', 'key', '-u', 'user', '-e', 'user@example.com',
+                         '-s', 'ssh-rsa AAAA', '--until', '2020:13:01']),
+]
+
+# modules the validation path must not import
+HEAVY = ['requests', 'urllib3', 'http_clients', 'pymacaroons', 'crypt', 'concurrent.futures',
+         'http.server', 'msu_gpgsign', 'msu_keys', 'msu_service', 'msu_bundle', 'tarfile']
+
+
+def measure(argv, runs, env):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(PYTHON + argv, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def heavyImports(argv, env):
+    res = subprocess.run(PYTHON + ['-X', 'importtime'] + argv, env=env,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    imported = set()
+    for line in str(res.stderr, 'utf-8').splitlines():
+        if line.startswith('import time:') and '|' in line:
+            imported.add(line.rsplit('|', 1)[1].strip())
+    return sorted(m for m in HEAVY if m in imported)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the startup time of msu.py.')
+    parser.add_argument('--runs', type=int, default=20,
+        help='Runs of each case: default 20.')
+    parser.add_argument('--target-ms', type=float, default=50.0,
+        help='The median startup time each msu.py case must stay under: default 50.')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.join(ROOT, 'src')
+    # byte-compile the launcher modules, as the snap build does
+    subprocess.run([sys.executable, '-m', 'compileall', '-q', BIN], check=True)
+    measure(CASES[1][1], 1, env)
+
+    failed = False
+    floor = None
+    print('{:<16} {:>10} {:>10} {:>10} {:>12}'.format('case', 'median ms', 'min ms', 'max ms', 'msu.py ms'))
+    for name, argv in CASES:
+        times = measure(argv, args.runs, env)
+        median = statistics.median(times) * 1000
+        if floor is None:
+            floor = median
+        over = name != 'interpreter' and median > args.target_ms
+        failed = failed or over
+        # what msu.py adds to the interpreter's own startup
+        print('{:<16} {:>10.1f} {:>10.1f} {:>10.1f} {:>12.1f}{}'.format(
+            name, median, min(times) * 1000, max(times) * 1000, median - floor, '  over target' if over else ''))
+
+    for name, argv in CASES[1:]:
+        heavy = heavyImports(argv, env)
+        if heavy:
+            failed = True
+            print('{} imports {}'.format(name, ', '.join(heavy)))
+
+    if failed:
+        sys.exit(1)
+    print('All cases under {:g} ms.'.format(args.target_ms))
+
+
+if __name__ == '__main__':
+    main()
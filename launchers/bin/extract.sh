@@ -0,0 +1,3 @@
+#!/bin/bash
+
+exec "$SNAP/bin/python3" -s "$SNAP/bin/msu_bundle.py" "$@"
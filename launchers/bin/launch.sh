@@ -2,4 +2,7 @@
 
 echo "NOTICE: As of March 31, 2024, make-system-user is officially deprecated. Please see https://forum.snapcraft.io/t/make-system-user-deprecation/39044 for more info." 1>&2
 
-$SNAP/bin/python3 $SNAP/bin/msu.py "$@"
+# msu is imported rather than run as a script so its precompiled bytecode is
+# used; the first argument takes the place of the current directory on
+# sys.path. -s: no user site-packages to scan. exec: no shell left waiting.
+exec "$SNAP/bin/python3" -s -c 'import sys; sys.path[0] = sys.argv.pop(1); import msu; sys.exit(msu.main(sys.argv))' "$SNAP/bin" "$@"
@@ -16,19 +16,23 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
  Kyle Nitzsche <kyle.nitzsche@canonical.com>
 """
 
+import os
 import sys
 import argparse
 import textwrap
 from argparse import RawTextHelpFormatter
-import subprocess
-import crypt
 import json
 import time
 from datetime import datetime, timedelta
-import json
-import http_clients
-import requests
-import getpass
+# Only modules needed to parse and check the arguments are imported here,
+# so --help and argument errors return quickly. The network clients, snap
+# and gpg helpers and output writers are imported by the phase using them.
+import msu_cache
+import msu_crypt
+import msu_output
+import msu_profile
+import msu_sign
+import msu_validate
 
 
 PROGRAM = ''
@@ -51,19 +55,30 @@ Create and sign a System-User Assertion using a local snapcraft key that has bee
     On success, an "auto-import.assert" file is created in the current directory. If this file is placed on a USB drive and it is inserted into an Ubuntu Core system, and if the system has neither a System User nor a user created through console-conf, then the System User is created with SSH access using the specified authentication.'''
         ))
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true')
+    parser.add_argument('--login', dest='login', action='store_true',
+        help=('Always prompt for the Ubuntu SSO login instead of first trying the credentials stored by a previous login.')
+        )
     parser.add_argument('-w', '--write', dest='write', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--profile', metavar='FILE',
+        help=('Time each phase of the run (macaroon, discharge, account fetch, snap keys, snap known, crypt, snap sign, write, and the store requests and retry waits inside them), print a summary table at exit and write all timings to FILE.')
+        )
+    parser.add_argument('--profile-format', choices=['json', 'chrome'],
+        default='json',
+        help=('The format of the --profile file: "json" (default) lists the spans, "chrome" writes trace events that chrome://tracing and Perfetto can show.')
+        )
+    # checked in main(): --calibrate-crypt needs none of them, --export-offline no brand or model
     required = parser.add_argument_group('Required arguments')
-    required.add_argument('-b', '--brand', required=True,
-        help=('The account-id of the account that signed the device\'s model-assertion.')
+    required.add_argument('-b', '--brand',
+        help=('The account-id of the account that signed the device\'s model-assertion. Not needed with --export-offline.')
         )
-    required.add_argument('-m', '--model', required=True,
-        help=('The model listed in the  device\'s model-assertion.')
+    required.add_argument('-m', '--model',
+        help=('The model listed in the  device\'s model-assertion. Not needed with --export-offline.')
         )
-    required.add_argument('-u', '--username', required=True,
-        help=('The username of the account to be created on the device')
+    required.add_argument('-u', '--username',
+        help=('The username of the account to be created on the device. Required unless --manifest is used.')
         )
-    required.add_argument('-e', '--email', required=True,
-        help=('The email address of the login.ubuntu.com account to be created on the device.')
+    required.add_argument('-e', '--email',
+        help=('The email address of the login.ubuntu.com account to be created on the device. Required unless --manifest is used.')
         )
     parser.add_argument('-p', '--password',
         help=('The password of the account to be created on the device. This password is not saved. Either this or --ssh-keys is required.')
@@ -75,6 +90,13 @@ Create and sign a System-User Assertion using a local snapcraft key that has bee
     parser.add_argument('--until',
         help=('Optionally specify the date until which the system user can be created in the following format: YYYY:MM:DD, for example "2021:02:28" for 28 Feb 2020. If omitted, the value is one year from the "since" date, which is two days before today.')
         )
+    parser.add_argument('--align-validity', choices=['day', 'week'],
+        help=('Optionally start the "since" and default "until" fields at midnight of the day, or of the Monday of the week, instead of at the current time of day. The same user then gets the same assertion content for the whole day or week, and its signed assertion is reused from the local cache instead of being signed again. Users with a password are always signed again.')
+        )
+    parser.add_argument('--sign-cache-size', type=int,
+        default=msu_cache.DEFAULT_SIGN_CACHE_SIZE // (1024 * 1024),
+        help=('Optionally specify how many MiB the cache of system-user assertions signed with --align-validity may use before the least recently used are removed: default is 64. Use 0 to disable the cache.')
+        )
     parser.add_argument('--serials', nargs='+',
         help=('Optionally add one or more serial numbers to limit creation of a system-user to a system of one of the specified serial numbers. Use a space to delimit them. For example: --serial-numbers \'123abc\' \'zyx321abc\'.')
         )
@@ -86,18 +108,97 @@ Create and sign a System-User Assertion using a local snapcraft key that has bee
     parser.add_argument('-s', '--ssh-keys', nargs="+",
         help=('Optionally add one or more public ssh keys to use for SSH using the system user to be created on the device. Either this or --password is required. Enclosed each key string in single quotes. Use a space to delimit them. For example: --ssh-keys \'key one\' \'key two\'.')
         )
-    required.add_argument('-k', '--key', required=True,
+    required.add_argument('-k', '--key',
         help=('The name of the snapcraft key to use to sign the system user assertion. The key must exist locally and be reported by "snapcraft keys". The key must also be registered.')
         )
+    parser.add_argument('--signer', choices=['snap', 'gpg-agent'],
+        default='snap',
+        help=('Optionally specify how the system-user assertion is signed: "snap" (default) runs "snap sign" for each assertion, "gpg-agent" signs in-process through the gpg-agent of the snap keyring, which is much faster for many assertions.')
+        )
+    parser.add_argument('--assertion-cache-ttl', type=int,
+        default=msu_cache.DEFAULT_TTL,
+        help=('Optionally specify for how many seconds the account and account-key assertions fetched from the store are reused from the local cache: default is one day. Use 0 to disable the cache.')
+        )
+    parser.add_argument('--refresh-assertions',
+        default=False,
+        action="store_true",
+        help=('Discard the cached account and account-key assertions and fetch them from the store again.')
+        )
+    offline = parser.add_argument_group('Offline mode')
+    offline.add_argument('--export-offline', metavar='FILE',
+        help=('Log in, fetch the account, the --key fingerprint and the account and account-key assertions, and write them to FILE for --offline use on a machine without network access. Only --key is needed. No login credentials are written to FILE.')
+        )
+    offline.add_argument('--offline', metavar='FILE',
+        help=('Sign with the account details and assertions in FILE, written by --export-offline, instead of logging in and fetching them: no network access is needed. The --key must be the one FILE was exported for and must be in the local snap keyring.')
+        )
+    service = parser.add_argument_group('Service mode')
+    service.add_argument('--serve',
+        help=('Log in once and then serve signing requests on this address until interrupted: "unix:PATH" for a unix socket only the current user can use, or "HOST:PORT" for TCP on a loopback address, which every local user can reach. Requests are not authenticated. POST a manifest row as a JSON object to /sign to get its auto-import.assert content; GET /stats for request rates and latencies.')
+        )
+    service.add_argument('--serve-queue', type=int,
+        default=64,
+        help=('The number of --serve requests accepted at once: default is 64. Further requests get a 503 response.')
+        )
+    hashing = parser.add_argument_group('Password hashing')
+    hashing.add_argument('--crypt-method', choices=sorted(msu_crypt.METHODS),
+        default=msu_crypt.DEFAULT_METHOD,
+        help=('The crypt method used to hash passwords: default is sha512.')
+        )
+    hashing.add_argument('--crypt-rounds', type=int,
+        help=('The number of crypt rounds used to hash passwords: default is the crypt default of 5000.')
+        )
+    hashing.add_argument('--hash-workers', type=int,
+        default=msu_crypt.defaultWorkers(),
+        help=('The number of processes hashing passwords in a --manifest run: default is the number of CPU cores.')
+        )
+    hashing.add_argument('--calibrate-crypt',
+        default=False,
+        action="store_true",
+        help=('Measure how many passwords per second this machine hashes with the selected --crypt-method, --crypt-rounds and --hash-workers, and exit. No other arguments are needed.')
+        )
+    batch = parser.add_argument_group('Batch mode')
+    batch.add_argument('--manifest',
+        help=('Create one assertion file per row of a CSV or JSONL manifest instead of a single user from the command line. Columns: username, email, password, ssh-keys, serials, until, force-password-change. List values (ssh-keys, serials) are delimited with ";". The login, account lookup and key checks are done once for the whole manifest.')
+        )
+    batch.add_argument('--sign-workers', type=int,
+        default=msu_sign.defaultWorkers(),
+        help=('The number of assertions signed in parallel in a --manifest run: default is the number of CPU cores.')
+        )
+    batch.add_argument('--combine',
+        default=False,
+        action="store_true",
+        help=('Write all users of the --manifest into a single auto-import.assert file in --output-dir, with the account and account-key assertions once followed by one system-user assertion per row. The users are signed in parallel.')
+        )
+    batch.add_argument('--output-dir',
+        help=('The directory to write the assertion files of a --manifest run to: default is the current directory.')
+        )
+    batch.add_argument('--output-tar',
+        help=('Write the assertion files of a --manifest run as entries of this tar archive instead of to --output-dir.')
+        )
+    batch.add_argument('--output-bundle',
+        help=('Write the assertion files of a --manifest run into this bundle file instead of to --output-dir. A bundle stores the account and account-key assertions once and indexes the system-user assertions by serial. Use "make-system-user.extract BUNDLE SERIAL" to get the auto-import.assert file of one device.')
+        )
+    batch.add_argument('--layout', choices=msu_output.LAYOUTS,
+        default='flat',
+        help=('How the assertion files of a --manifest run are named: "flat" (default) writes ROW-USERNAME.auto-import.assert files, "per-serial" writes SERIAL/auto-import.assert for each serial of a row.')
+        )
+    batch.add_argument('--journal',
+        help=('Append a record of every row whose assertion file is written to this file, and skip the rows it already records when the run is repeated, so an interrupted --manifest run can be resumed. Only with --output-dir.')
+        )
     args = parser.parse_args()
     return args
 
-def get_macaroon():
-    authClient = http_clients.UbuntuOneAuthClient()
+def dashboardUrl(path):
+    from urllib.parse import urljoin
+    from http_clients import constants
+    # STORE_DASHBOARD_URL points the store requests elsewhere, as UBUNTU_ONE_SSO_URL does for the SSO ones
+    return urljoin(os.environ.get("STORE_DASHBOARD_URL", constants.STORE_DASHBOARD_URL), path)
 
+def get_macaroon():
+    import requests
     # get macaroon for account
 
-    url = "https://dashboard.snapcraft.io/dev/api/acl/"
+    url = dashboardUrl("/dev/api/acl/")
     data = {"permissions":[
                 "package_access",
                 "package_manage",
@@ -108,12 +209,13 @@ def get_macaroon():
             ]}
 
     # getting macaroon can only be anonymous, so no auth client
-    response = requests.request(
-        "POST",
-        url,
-        data=json.dumps(data),
-        headers={"Content-Type": "application/json", "Accept": "application/json"},
-    )
+    with msu_profile.span('macaroon'):
+        response = requests.request(
+            "POST",
+            url,
+            data=json.dumps(data),
+            headers={"Content-Type": "application/json", "Accept": "application/json"},
+        )
 
     if not response.ok:
         print('Error getting macaroon')
@@ -123,73 +225,150 @@ def get_macaroon():
     return response.json()["macaroon"]
 
 
-def ssoAccount(args):
+def ssoLogin(authClient):
+    """Interactively log in to Ubuntu SSO and store the new credentials."""
+    import getpass
     _macaroon = get_macaroon()
     _email = input("Ubuntu SSO email address: ")
     _password = getpass.getpass("Password: ")
     _otp = input("Second-factor auth: ")
 
-    authClient = http_clients.UbuntuOneAuthClient()
-
     try:
-        if len(_otp) == 0:
-           authClient.login(_email, _password, _macaroon)
-        else:
-           authClient.login(_email, _password, _macaroon, _otp)
+        with msu_profile.span('discharge'):
+            if len(_otp) == 0:
+               authClient.login(_email, _password, _macaroon)
+            else:
+               authClient.login(_email, _password, _macaroon, _otp)
 
     except:
         print("Error: Your login did not succeed")
         return False
+    return True
 
-    # get account info
-    url = "https://dashboard.snapcraft.io/dev/api/account"
-    headers = str
-    response = authClient.request(
-        "GET",
-        url,
-        headers={"Content-Type": "application/json", "Accept": "application/json", "Authorization": authClient.auth},
-    )
 
+def getAccount(authClient):
+    url = dashboardUrl("/dev/api/account")
+    with msu_profile.span('account fetch'):
+        return authClient.request(
+            "GET",
+            url,
+            headers={"Content-Type": "application/json", "Accept": "application/json", "Authorization": authClient.auth},
+        )
+
+
+def ssoAccount(args, beforeLogin=None):
+    """Return the account of the stored credentials, logging in again if the store rejects them.
+
+    beforeLogin() is called before the interactive login, which only
+    starts if it returns True, so a run that fails anyway does not prompt.
+    """
+    import http_clients
+    import requests
+    from http_clients import errors
+    if msu_profile.active() is not None:
+        http_clients.set_tracer(msu_profile.active())
+    authClient = http_clients.UbuntuOneAuthClient()
+
+    def fetchAccount(authErrors=()):
+        """Return the account response, exiting on any error but authErrors."""
+        try:
+            return getAccount(authClient)
+        except authErrors:
+            raise
+        except errors.HttpClientError as e:
+            # e.g. the store or SSO cannot be reached, logging in again cannot help
+            print('Error getting account info')
+            print(e)
+            exit_msg(1)
+
+    # Try the credentials already stored in snapcraft.cfg first and only
+    # fall back to the interactive login when the store rejects them.
+    response = None
+    if not args.login:
+        try:
+            response = fetchAccount((errors.InvalidCredentialsError, errors.StoreAuthenticationError))
+        except (errors.InvalidCredentialsError, errors.StoreAuthenticationError):
+            # e.g. refreshing an expired discharge was refused
+            response = None
+        if response is not None and response.status_code in (requests.codes.unauthorized, requests.codes.forbidden):
+            response = None
+        if response is None and args.verbose:
+            print("Stored credentials were rejected, logging in again.")
+
+    if response is None:
+        if beforeLogin is not None and not beforeLogin():
+            exit_msg(1)
+        if not ssoLogin(authClient):
+            return False
+        response = fetchAccount()
+
+    # get account info
     if not response.ok:
         print('Error getting account info')
         print(response.text)
         exit_msg(1)
 
+    if args.verbose:
+        print("==== Store requests:")
+        print(json.dumps(authClient.metrics.snapshot(), sort_keys=True, indent=4))
+
     if args.write:
         f = open("out.json", "w")
         f.write(json.dumps(response.json(), indent=2))
         f.close()
     return response.json()
 
-def pword_hash(pword):
-    return crypt.crypt(pword, crypt.mksalt(crypt.METHOD_SHA512))
+def pword_hash(pword, method=msu_crypt.DEFAULT_METHOD, rounds=None):
+    return msu_crypt.hashPassword(pword, method, rounds)
 def key_fingerprint(key, account):
+    import msu_keys
     # ensure store reports key
-    if len(account['account_keys']) > 0:
-        for k in account['account_keys']:
-            if k['name'] == key:
-                return k['public-key-sha3-384']
+    fingerprint = msu_keys.storeKeys(account).get(key)
+    if fingerprint:
+        return fingerprint
     print("Error: key '{}' is not reported by the store as one of your registered and local keys. Please use snapcraft create-key KEY' or 'snapcraft register-key KEY' and 'snapcraft keys' as needed".format(key))
     return False
 
-def accountAssert(id):
+def accountAssert(id, cache=None):
+    import subprocess
+    if cache is not None:
+        signed = cache.get('account', id)
+        if signed:
+            return(signed)
     cmd = ['snap', 'known', '--remote', 'account', 'account-id={}'.format(id)]
-    res = subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
+    with msu_profile.span('snap known', type='account'):
+        res = subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
     signed = str(res,'utf-8')
     if "type: account\n" not in signed:
         print("Error: problems getting assertion for this account")
         return False
+    if cache is not None:
+        cache.put('account', id, signed)
     return(signed)
 
-def accountKeyAssert(id):
+def accountKeyAssert(id, cache=None):
+    import subprocess
+    if cache is not None:
+        signed = cache.get('account-key', id)
+        if signed:
+            return(signed)
     cmd = ['snap', 'known', '--remote', 'account-key', 'public-key-sha3-384={}'.format(id)]
-    res = subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
+    with msu_profile.span('snap known', type='account-key'):
+        res = subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
     signed = str(res,'utf-8')
     if "type: account-key\n" not in signed:
         print("Error: problems getting assertion for this account-key")
         return False
+    if cache is not None:
+        cache.put('account-key', id, signed)
     return(signed)
 
+def assertionCache(args):
+    """Return the assertion cache for this run, or None if caching is disabled."""
+    if args.assertion_cache_ttl <= 0:
+        return None
+    return msu_cache.AssertionCache(ttl=args.assertion_cache_ttl)
+
 def getUntil(argsuntil, dt, d, t):
     if argsuntil is None:
         d = dt.replace(year = dt.year + 1).strftime('%Y-%m-%d')
@@ -210,7 +389,7 @@ def getUntil(argsuntil, dt, d, t):
         until = d2 + 'T00:00:00-00:01'
     return(until)
 
-def systemUserJson(account, brand, model, username, since_days_ago, until, email):
+def systemUserJson(account, brand, model, username, since_days_ago, until, email, align=None):
     data = dict()
     data["type"] = "system-user"
     data["authority-id"] = account
@@ -227,6 +406,10 @@ def systemUserJson(account, brand, model, username, since_days_ago, until, email
     ts = time.time()
     dt = datetime.fromtimestamp(ts)
     dt = dt - timedelta(days=since_delta)
+    if align is not None:
+        dt = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+        if align == 'week':
+            dt = dt - timedelta(days=dt.weekday())
     d = dt.strftime('%Y-%m-%d')
     t = dt.strftime('%H:%M:%S')
     since = d + 'T00:00:00-00:01'
@@ -247,108 +430,452 @@ def systemUserJson(account, brand, model, username, since_days_ago, until, email
     return data
 
 def isLocalKey(key):
-    cmd = ['snap', 'keys']
-    res = subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
-    lines = str(res,'utf-8').split('\n')
-    for line in lines:
-        if key in line:
-            return True
+    import msu_keys
+    if key in msu_keys.localKeys():
+        return True
     print("Error: key '{}' is not a local key. Please use snapcraft create-key' and then 'snapcraft register-key'".format(key))
     return False
 
-def signUser(userJson, key):
-    cmd = "echo '" + json.dumps(userJson) + "'| snap sign -k " + key
-    res = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE).communicate()[0]
-    signed = str(res,'utf-8')
-    return(signed)
+def makeSigner(args, selfSignKey):
+    """Return the function signing assertions for the selected --signer."""
+    if args.signer == 'snap':
+        return msu_sign.signAssertion
+    import msu_gpgsign
+    try:
+        return msu_gpgsign.AgentSigner(args.key, selfSignKey)
+    except msu_sign.SignError as e:
+        print("Error: cannot use the gpg-agent signer: {}".format(e))
+        exit_msg(1)
+
+def signUser(userJson, key, sign=msu_sign.signAssertion):
+    try:
+        return sign(userJson, key)
+    except msu_sign.SignError as e:
+        print("Error: signing the system-user assertion failed: {}".format(e))
+        exit_msg(1)
+
+def userFromArgs(args):
+    return {
+        'row': None,
+        'username': args.username,
+        'email': args.email,
+        'password': args.password,
+        'ssh_keys': args.ssh_keys,
+        'serials': args.serials,
+        'until': args.until,
+        'force_password_change': args.force_password_change,
+    }
+
+def userJsonFor(accountId, args, user):
+    userJson = systemUserJson(accountId, args.brand, args.model, user['username'], int(args.since_days_ago), user['until'], user['email'], args.align_validity)
+    if user['password']:
+        if user.get('password_hash') is not None:
+            userJson["password"] = user['password_hash'].result()
+        else:
+            userJson["password"] = pword_hash(user['password'], args.crypt_method, args.crypt_rounds)
+        if user['force_password_change']:
+            userJson["force-password-change"] = "true"
+    else: #ssh pub key
+        userJson["ssh-keys"] = user['ssh_keys']
+
+    if user['serials']:
+        userJson["format"] = "1";
+        userJson["serials"] = user['serials']
+    return userJson
+
+def preflight(args):
+    """Log in and fetch everything that is shared by all users signed in this run.
+
+    Steps that do not depend on each other run at the same time: "snap keys"
+    runs while the account is fetched, and the account and account-key
+    assertions are fetched together once the key fingerprint is known.
+    The first failing step ends the run.
+
+    :return: the account info, the key fingerprint, and the signed account and
+             account-key assertions.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        localKey = executor.submit(isLocalKey, args.key)
+
+        # quit if not snapcraft logged in, or before prompting for the
+        # login if the key is not local
+        account = ssoAccount(args, beforeLogin=localKey.result)
+        if not account:
+            exit_msg(1)
+        # quit if key is not registered
+        selfSignKey = key_fingerprint(args.key, account)
+        if not selfSignKey:
+            exit_msg(1)
+        # quit if key does is not local
+        if not localKey.result():
+            exit_msg(1)
+
+        if args.verbose:
+            print("==== Args and related:")
+            print("Version: ", VERSION)
+            print("Brand ", args.brand)
+            print("Model", args.model)
+            print("Username", args.username)
+            print("Password", args.password)
+            print("Email", args.email)
+            print("SSH", args.ssh_keys)
+            print("ForcePasswordChange", args.force_password_change)
+            print("Manifest", args.manifest)
+            print("Account-Id: ", json.dumps(account, sort_keys=True, indent=4))
+            print("Key: ", args.key)
+            print("Key Fingerprint: ", selfSignKey)
+            print("Since days ago: ", args.since_days_ago)
+            print("")
+
+        cache = assertionCache(args)
+        if cache is not None and args.refresh_assertions:
+            cache.invalidate('account', account['account_id'])
+            cache.invalidate('account-key', selfSignKey)
+
+        accountFuture = executor.submit(accountAssert, account['account_id'], cache)
+        accountKeyFuture = executor.submit(accountKeyAssert, selfSignKey, cache)
+        for future in as_completed([accountFuture, accountKeyFuture]):
+            if not future.result():
+                exit_msg(1)
+        accountSigned = accountFuture.result()
+        accountKeySigned = accountKeyFuture.result()
+
+    if args.verbose:
+        print("==== Account signed:")
+        print(accountSigned)
+        print("==== Account Key signed:")
+        print(accountKeySigned)
+
+    return account, selfSignKey, accountSigned, accountKeySigned
+
+def offlinePreflight(args):
+    """Return what preflight() returns from the --offline file, without network access."""
+    import msu_keys
+    import msu_offline
+    try:
+        data = msu_offline.load(args.offline)
+    except msu_offline.OfflineError as e:
+        print("Error: cannot use the offline file {}: {}".format(args.offline, e))
+        exit_msg(1)
+    if data['key'] != args.key:
+        print("Error: the offline file {} was exported for key '{}', not '{}'.".format(args.offline, data['key'], args.key))
+        exit_msg(1)
+    if not isLocalKey(args.key):
+        exit_msg(1)
+    if msu_keys.localKeys().get(args.key) != data['fingerprint']:
+        print("Error: the local key '{}' is not the key the offline file {} was exported for.".format(args.key, args.offline))
+        exit_msg(1)
+
+    if args.verbose:
+        print("==== Offline file:")
+        print("File: ", args.offline)
+        print("Created: ", data['created'])
+        print("Account-Id: ", data['account']['account_id'])
+        print("Key: ", args.key)
+        print("Key Fingerprint: ", data['fingerprint'])
+        print("")
+
+    return data['account'], data['fingerprint'], data['account-assertion'], data['account-key-assertion']
+
+def exportOffline(args):
+    import msu_offline
+    account, selfSignKey, accountSigned, accountKeySigned = preflight(args)
+    try:
+        msu_offline.export(args.export_offline, account, args.key, selfSignKey, accountSigned, accountKeySigned)
+    except (OSError, msu_offline.OfflineError) as e:
+        print("Error: cannot write the offline file {}: {}".format(args.export_offline, e))
+        exit_msg(1)
+    print("Done. Use --offline {} with key '{}' to sign without network access.".format(args.export_offline, args.key))
+
+def batchWriter(args):
+    if args.output_bundle:
+        import msu_bundle
+        return msu_bundle.BundleWriter(args.output_bundle)
+    if args.output_tar:
+        return msu_output.TarWriter(args.output_tar, args.layout)
+    return msu_output.DirectoryWriter(args.output_dir, args.layout)
+
+def batchJobs(args, users, account):
+    for user in users:
+        userJson = userJsonFor(account['account_id'], args, user)
+        if args.verbose:
+            print("==== system-user json (row {}):".format(user['row']))
+            print(json.dumps(userJson, sort_keys=True, indent=4))
+        yield user, userJson
+
+def runCombined(args, users, account, accountSigned, accountKeySigned, sign):
+    """Sign all manifest users into one file that holds the account and account-key assertions once."""
+    filename = os.path.join(args.output_dir, msu_output.FILENAME)
+
+    def parts(pool):
+        yield accountSigned
+        yield accountKeySigned
+        for result in pool.signAll(batchJobs(args, users, account)):
+            if result.error is not None:
+                print("Error: row {}: signing the system-user assertion failed: {}".format(result.job['row'], result.error))
+                # nothing is written unless every user is signed
+                raise msu_sign.SignError(str(result.error))
+            yield result.signed
+
+    with msu_sign.SignerPool(args.key, args.sign_workers, sign) as pool:
+        try:
+            os.makedirs(args.output_dir, exist_ok=True)
+            with msu_profile.span('write'):
+                msu_output.atomicWrite(filename, parts(pool))
+        except msu_sign.SignError:
+            exit_msg(1)
+        except OSError as e:
+            print("Error: cannot write {}: {}".format(filename, e))
+            exit_msg(1)
+    print("Done. {} system users written to {}.".format(len(users), filename))
+
+def runBatch(args, users, account, accountSigned, accountKeySigned, sign, journal=None):
+
+    count = 0
+    failed = 0
+    with batchWriter(args) as writer, msu_sign.SignerPool(args.key, args.sign_workers, sign) as pool:
+        for result in pool.signAll(batchJobs(args, users, account)):
+            user = result.job
+            if result.error is not None:
+                print("Error: row {}: signing the system-user assertion failed: {}".format(user['row'], result.error))
+                failed += 1
+                continue
+            parts = (accountSigned, accountKeySigned, result.signed)
+            with msu_profile.span('write'):
+                writer.write(user, parts)
+                if journal is not None:
+                    paths = [os.path.abspath(os.path.join(args.output_dir, name)) for name in msu_output.entryNames(user, args.layout)]
+                    journal.record(user, paths, parts)
+            count += 1
+    print("Done. {} assertion files written to {}.".format(count, args.output_bundle or args.output_tar or args.output_dir))
+    if failed:
+        print("Error: {} rows could not be signed.".format(failed))
+        exit_msg(1)
+
+def runService(args, account, accountSigned, accountKeySigned, sign):
+    """Serve signing requests until interrupted, reusing this run's login and pre-flight results."""
+    import msu_manifest
+    import msu_service
+
+    def signRow(row):
+        try:
+            user = msu_manifest.normalizeRow(None, row)
+        except msu_manifest.ManifestError as e:
+            raise msu_service.RequestError(400, e.message)
+        errors = msu_validate.checkUser(user, msu_validate.sinceLimit(args.since_days_ago))
+        if errors:
+            raise msu_service.RequestError(400, " ".join(errors))
+        userJson = userJsonFor(account['account_id'], args, user)
+        userSigned = pool.submit(userJson).result()
+        return accountSigned + "\n" + accountKeySigned + "\n" + userSigned
+
+    with msu_sign.SignerPool(args.key, args.sign_workers, sign) as pool:
+        try:
+            server = msu_service.makeServer(args.serve, signRow, args.serve_queue, args.verbose)
+        except msu_service.ServiceError as e:
+            print("Error. Cannot serve on {}: {}".format(args.serve, e.message))
+            exit_msg(1)
+        except OSError as e:
+            print("Error. Cannot serve on {}: {}".format(args.serve, e))
+            exit_msg(1)
+        print("Serving signing requests on {}. Press Ctrl-C to stop.".format(args.serve))
+        msu_service.serve(server)
+
+def calibrateCrypt(args):
+    rounds = args.crypt_rounds if args.crypt_rounds else "default"
+    print("Measuring {} password hashing with {} rounds...".format(args.crypt_method, rounds))
+    single, parallel = msu_crypt.calibrate(args.crypt_method, args.crypt_rounds, args.hash_workers)
+    print("1 process: {:10.1f} hashes/s".format(single))
+    print("{} processes: {:10.1f} hashes/s".format(args.hash_workers, parallel))
 
 def main(argv=None):
     args = parseargs(argv)
-    if args.password is None and args.ssh_keys is None:
-        print("Error. You must supply either a password or public SSH keys(s).")
+    if args.profile:
+        msu_profile.enable(args.profile, args.profile_format)
+    if args.crypt_rounds is not None and not msu_crypt.MIN_ROUNDS <= args.crypt_rounds <= msu_crypt.MAX_ROUNDS:
+        print("Error. --crypt-rounds must be from {} to {}.".format(msu_crypt.MIN_ROUNDS, msu_crypt.MAX_ROUNDS))
+        exit_msg(1)
+    if args.hash_workers < 1:
+        print("Error. --hash-workers must be at least 1.")
         exit_msg(1)
-    if args.password is not None and args.ssh_keys is not None:
-        print("Error. You cannot use both a password and an ssh key.")
+    if args.sign_workers < 1:
+        print("Error. --sign-workers must be at least 1.")
         exit_msg(1)
-    if args.force_password_change and args.password is None:
-        print("Error. Using --force-password-change also requires --password.")
+    if args.calibrate_crypt:
+        calibrateCrypt(args)
+        exit_msg(0)
+    if args.key is None:
+        print("Error. -k/--key is required.")
         exit_msg(1)
-    if args.force_password_change and args.ssh_keys is not None:
-        print("Error. Using --force-password-change with --ssh-keys is not allowed.")
+    if not args.export_offline and (args.brand is None or args.model is None):
+        print("Error. -b/--brand and -m/--model are required unless --export-offline is used.")
         exit_msg(1)
     if args.since_days_ago is not None and not args.since_days_ago.isdigit():
         print("Error. --since-days-ago must be an integer.")
         exit_msg(1)
 
-    # quit if not snapcraft logged in
-    account = ssoAccount(args)
-    if not account:
+    if args.output_bundle and args.output_tar:
+        print("Error. Use only one of --output-bundle and --output-tar.")
         exit_msg(1)
-    # quit if key is not registered
-    selfSignKey = key_fingerprint(args.key, account)
-    if not selfSignKey:
+
+    if args.combine and (args.output_bundle or args.output_tar or args.layout != 'flat'):
+        print("Error. --combine writes a single file, it cannot be used with --output-bundle, --output-tar or --layout.")
         exit_msg(1)
-    # quit if key does is not local
-    if not isLocalKey(args.key):
+    if args.output_bundle and args.layout != 'flat':
+        print("Error. --output-bundle finds each device by its serial, it cannot be used with --layout.")
         exit_msg(1)
+    if args.journal and (not args.manifest or args.combine or args.output_bundle or args.output_tar):
+        print("Error. --journal resumes --manifest runs that write to --output-dir, it cannot be used with --combine, --output-bundle or --output-tar.")
+        exit_msg(1)
+    if args.serve and args.manifest:
+        print("Error. Use only one of --serve and --manifest.")
+        exit_msg(1)
+    if args.combine and not args.manifest:
+        print("Error. --combine requires --manifest.")
+        exit_msg(1)
+    if not args.manifest and (args.output_dir is not None or args.output_tar or args.output_bundle):
+        print("Error. --output-dir, --output-tar and --output-bundle require --manifest.")
+        exit_msg(1)
+    if args.output_dir is None:
+        args.output_dir = '.'
+    if args.export_offline and args.offline:
+        print("Error. Use only one of --export-offline and --offline.")
+        exit_msg(1)
+    if args.export_offline:
+        if args.manifest or args.serve or args.username or args.email or args.password or args.ssh_keys or args.serials or args.until or args.force_password_change:
+            print("Error. --export-offline only fetches the account details, it cannot be combined with users to sign.")
+            exit_msg(1)
+        exportOffline(args)
+        exit_msg(0)
+
+    users = None
+    if args.manifest:
+        if args.username or args.email or args.password or args.ssh_keys or args.serials or args.until or args.force_password_change:
+            print("Error. --manifest cannot be combined with the single user arguments.")
+            exit_msg(1)
+        import msu_manifest
+        try:
+            users, readErrors = msu_manifest.loadManifest(args.manifest)
+        except OSError as e:
+            print("Error. Cannot read manifest {}: {}".format(args.manifest, e))
+            exit_msg(1)
+        uniqueKeys = None
+        if args.output_bundle:
+            import msu_bundle
+            uniqueKeys = msu_bundle.bundleKeys
+        elif args.layout == 'per-serial' and not args.combine:
+            uniqueKeys = msu_validate.serialKeys
+        errors = [(e.row, e.message) for e in readErrors]
+        errors += msu_validate.checkUsers(users, msu_validate.sinceLimit(args.since_days_ago), uniqueKeys)
+        if errors:
+            for row, message in sorted(errors, key=lambda error: error[0]):
+                print("Error. Manifest row {}: {}".format(row, message))
+            print("{} errors in manifest {}, nothing was signed.".format(len(errors), args.manifest))
+            exit_msg(1)
+    elif args.serve:
+        if args.username or args.email or args.password or args.ssh_keys or args.serials or args.until or args.force_password_change:
+            print("Error. --serve takes the users from its requests, it cannot be combined with the single user arguments.")
+            exit_msg(1)
+        import msu_service
+        error = msu_service.checkAddress(args.serve)
+        if error:
+            print("Error. Cannot serve on {}: {}".format(args.serve, error))
+            exit_msg(1)
+    else:
+        if args.username is None or args.email is None:
+            print("Error. --username and --email are required unless --manifest is used.")
+            exit_msg(1)
+        errors = msu_validate.checkUser(userFromArgs(args), msu_validate.sinceLimit(args.since_days_ago))
+        if errors:
+            for message in errors:
+                print("Error. " + message)
+            exit_msg(1)
+
+    journal = None
+    if args.journal:
+        import msu_journal
+        # everything that decides where a row is written and what it holds
+        settings = {
+            'brand': args.brand,
+            'model': args.model,
+            'key': args.key,
+            'layout': args.layout,
+            'output-dir': os.path.abspath(args.output_dir),
+            'since-days-ago': int(args.since_days_ago),
+            'align-validity': args.align_validity,
+            'crypt-method': args.crypt_method,
+            'crypt-rounds': args.crypt_rounds,
+        }
+        try:
+            journal = msu_journal.Journal(args.journal, settings)
+        except OSError as e:
+            print("Error. Cannot open journal {}: {}".format(args.journal, e.strerror))
+            exit_msg(1)
+        pending = [user for user in users if not journal.done(user)]
+        if len(pending) < len(users):
+            print("Resuming. {} of {} rows were already written, {} left.".format(len(users) - len(pending), len(users), len(pending)))
+        users = pending
+        if not users:
+            journal.close()
+            print("Done. 0 assertion files written to {}.".format(args.output_dir))
+            exit_msg(0)
+
+    hashPool = None
+    if users is not None and any(user['password'] for user in users):
+        # hash the passwords while the login and the store requests run
+        hashPool = msu_crypt.HashPool(args.crypt_method, args.crypt_rounds, args.hash_workers)
+        for user in users:
+            if user['password']:
+                user['password_hash'] = hashPool.submit(user['password'])
+
+    if args.offline:
+        account, selfSignKey, accountSigned, accountKeySigned = offlinePreflight(args)
+    else:
+        account, selfSignKey, accountSigned, accountKeySigned = preflight(args)
 
-    if args.verbose:
-        print("==== Args and related:")
-        print("Version: ", VERSION)
-        print("Brand ", args.brand)
-        print("Model", args.model)
-        print("Username", args.username)
-        print("Password", args.password)
-        print("Email", args.email)
-        print("SSH", args.ssh_keys)
-        print("ForcePasswordChange", args.force_password_change)
-        print("Account-Id: ", json.dumps(account, sort_keys=True, indent=4))
-        print("Key: ", args.key)
-        print("Key Fingerprint: ", selfSignKey)
-        print("Since days ago: ", args.since_days_ago)
-        print("")
-
-    accountSigned = accountAssert(account['account_id'])
-    if args.verbose:
-        print("==== Account signed:")
-        print(accountSigned)
-
-    accountKeySigned = accountKeyAssert(selfSignKey)
-    if args.verbose:
-        print("==== Account Key signed:")
-        print(accountKeySigned)
+    sign = makeSigner(args, selfSignKey)
+    if args.align_validity and args.sign_cache_size > 0:
+        sign = msu_cache.cachedSigner(sign, msu_cache.SignCache(maxSize=args.sign_cache_size * 1024 * 1024), selfSignKey)
 
-    userJson = systemUserJson(account['account_id'], args.brand, args.model, args.username, int(args.since_days_ago), args.until, args.email)
-    if args.password:
-        userJson["password"] = pword_hash(args.password)
-        if args.force_password_change:
-            userJson["force-password-change"] = "true"
-    else: #ssh pub key
-        userJson["ssh-keys"] = args.ssh_keys
+    if args.serve:
+        runService(args, account, accountSigned, accountKeySigned, sign)
+        exit_msg(0)
 
-    if args.serials:
-        userJson["format"] = "1";
-        userJson["serials"] = args.serials
+    if users is not None:
+        try:
+            if args.combine:
+                runCombined(args, users, account, accountSigned, accountKeySigned, sign)
+            else:
+                runBatch(args, users, account, accountSigned, accountKeySigned, sign, journal)
+        finally:
+            if hashPool is not None:
+                hashPool.close()
+            if journal is not None:
+                journal.close()
+        exit_msg(0)
+
+    userJson = userJsonFor(account['account_id'], args, userFromArgs(args))
 
     if args.verbose:
         print("==== system-user json:")
         print(json.dumps(userJson, sort_keys=True, indent=4))
 
-    userSigned = signUser(userJson, args.key)
+    userSigned = signUser(userJson, args.key, sign)
 
-    user = accountSigned + "\n" + accountKeySigned + "\n" + userSigned
     if args.verbose:
         print("==== System-user signed:")
-        print(user)
+        print(userSigned)
 
-    filename = "auto-import.assert"
-    with open(filename, 'w') as out:
-        out.write(user)
+    filename = msu_output.FILENAME
+    with msu_profile.span('write'):
+        msu_output.atomicWrite(filename, (accountSigned, accountKeySigned, userSigned))
 
     print("Done. You may copy {} to a USB stick and insert it into an unmanaged Core system, after which you can log in using the credentials you provided.".format(filename))
     exit_msg(0)
 
 def exit_msg(status):
+    msu_profile.finish()
     if status == 0:
         print("\nExiting.")
         sys.exit(0)
@@ -0,0 +1,208 @@
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Multi-device assertion bundles.
+
+A bundle holds the auto-import.assert files of a whole batch in one file.
+The account and account-key assertions, which are the same for every
+device, are stored once. Each device's system-user assertion is stored once
+and found through a hash table keyed by serial, so one device's file can be
+extracted without reading the rest of the bundle:
+
+    header   magic, index offset, index slot count, prefix length
+    prefix   account assertion + "\\n" + account-key assertion + "\\n"
+    data     the signed system-user assertions, one after another
+    index    slots of (key hash, data offset, data length)
+
+Rows without serials are keyed by their username instead.
+
+Usage: msu_bundle.py BUNDLE SERIAL [-o FILE]
+"""
+
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+import msu_output
+
+MAGIC = b'MSUBNDL1'
+_HEADER = struct.Struct('<8sQQQ')
+_SLOT = struct.Struct('<16sQQ')
+_EMPTY = b'\0' * 16
+
+
+class BundleError(Exception):
+    pass
+
+
+def keyHash(key):
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+    # the all-zero hash marks empty slots
+    return digest if digest != _EMPTY else b'\1' + digest[1:]
+
+
+def _slotCount(entries):
+    # keep the table at most half full so probes stay short
+    count = 1
+    while count < 2 * entries:
+        count *= 2
+    return count
+
+
+def bundleKeys(user):
+    return user['serials'] if user['serials'] else [user['username']]
+
+
+class BundleWriter:
+    """Write batch outputs into a bundle.
+
+    The account and account-key assertions are taken from the first output
+    written. The bundle is written to a temporary file next to path and
+    only renamed to path once it is complete.
+    """
+
+    def __init__(self, path, layout=None):
+        self.path = path
+        fd, self._tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp-')
+        self._file = os.fdopen(fd, 'w+b')
+        self._file.write(_HEADER.pack(MAGIC, 0, 0, 0))
+        self._prefixLength = None
+        self._entries = []
+        self._keys = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        if excType is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, user, parts):
+        if self._prefixLength is None:
+            prefix = "".join(part + "\n" for part in parts[:-1]).encode('utf-8')
+            self._file.write(prefix)
+            self._prefixLength = len(prefix)
+        data = parts[-1].encode('utf-8')
+        offset = self._file.tell()
+        self._file.write(data)
+        for key in bundleKeys(user):
+            h = keyHash(key)
+            if h in self._keys:
+                raise BundleError("{} is in the bundle twice".format(key))
+            self._keys.add(h)
+            self._entries.append((h, offset, len(data)))
+
+    def close(self):
+        slotCount = _slotCount(len(self._entries))
+        slots = [None] * slotCount
+        for entry in self._entries:
+            i = int.from_bytes(entry[0][:8], 'little') & (slotCount - 1)
+            while slots[i] is not None:
+                i = (i + 1) & (slotCount - 1)
+            slots[i] = entry
+        indexOffset = self._file.tell()
+        for slot in slots:
+            self._file.write(_SLOT.pack(*slot) if slot is not None else _SLOT.pack(_EMPTY, 0, 0))
+        self._file.seek(0)
+        self._file.write(_HEADER.pack(MAGIC, indexOffset, slotCount, self._prefixLength or 0))
+        self._file.close()
+        os.chmod(self._tmp, msu_output.fileMode())
+        os.replace(self._tmp, self.path)
+
+    def abort(self):
+        self._file.close()
+        os.unlink(self._tmp)
+
+
+class Bundle:
+    """Random access to the outputs in a bundle file."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < _HEADER.size:
+            raise BundleError("{} is not a bundle".format(path))
+        magic, self._indexOffset, self._slotCount, self._prefixLength = _HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise BundleError("{} is not a bundle".format(path))
+        # a cut short or damaged file must not be read past its end
+        self._dataStart = _HEADER.size + self._prefixLength
+        if (self._slotCount & (self._slotCount - 1)
+                or self._dataStart > self._indexOffset
+                or self._indexOffset + self._slotCount * _SLOT.size > len(self._map)):
+            self._map.close()
+            raise BundleError("{} is truncated or damaged".format(path))
+        self.path = path
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get(self, key):
+        """Return the auto-import.assert content for a serial, or None if it is not in the bundle."""
+        if self._slotCount == 0:
+            return None
+        h = keyHash(key)
+        i = int.from_bytes(h[:8], 'little') & (self._slotCount - 1)
+        while True:
+            slotHash, offset, length = _SLOT.unpack_from(self._map, self._indexOffset + i * _SLOT.size)
+            if slotHash == _EMPTY:
+                return None
+            if slotHash == h:
+                if offset < self._dataStart or offset + length > self._indexOffset:
+                    raise BundleError("{} is damaged: the entry of {} is outside its data".format(self.path, key))
+                return self._map[_HEADER.size:_HEADER.size + self._prefixLength] + self._map[offset:offset + length]
+            i = (i + 1) & (self._slotCount - 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Extract the auto-import.assert file of one device from a bundle written with --output-bundle.')
+    parser.add_argument('bundle', help='The bundle file.')
+    parser.add_argument('serial', help='The serial of the device, or the username for rows without serials.')
+    parser.add_argument('-o', '--output', default='auto-import.assert',
+        help='The file to write: default is auto-import.assert in the current directory. Use - for standard output.')
+    args = parser.parse_args(argv)
+
+    try:
+        with Bundle(args.bundle) as bundle:
+            content = bundle.get(args.serial)
+    except (OSError, ValueError, BundleError) as e:
+        print("Error: {}".format(e))
+        return 1
+    if content is None:
+        print("Error: {} is not in {}".format(args.serial, args.bundle))
+        return 1
+    if args.output == '-':
+        sys.stdout.buffer.write(content)
+    else:
+        with open(args.output, 'wb') as out:
+            out.write(content)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,212 @@
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+On-disk caches for signed assertions.
+
+Account and account-key assertions are immutable signed text for a given
+account-id or public-key-sha3-384, so they can be reused between runs. Each
+entry is stored as a plain file named after its primary key, in a directory
+named after its assertion type, and expires after a configurable TTL.
+
+System-user assertions signed by this tool are cached by SignCache, under
+the hash of the key name, its fingerprint and the canonical JSON that was
+signed, so a key re-created under the same name does not hit. Only a
+payload that is the same from run to run can hit, which takes
+--align-validity. Entries are evicted least recently used first once the
+cache is over its size limit.
+"""
+
+import os
+import re
+import time
+
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_SIGN_CACHE_SIZE = 64 * 1024 * 1024
+
+# account-ids and key fingerprints are base64url-ish strings
+_VALID_KEY = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+def defaultCacheDir(name='assertions'):
+    from xdg import BaseDirectory
+    return os.path.join(BaseDirectory.save_cache_path('make-system-user'), name)
+
+
+def _writeEntry(path, signed):
+    import tempfile
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            f.write(signed)
+        os.replace(tmp, path)
+    except OSError as e:
+        # the cache is an optimization only, never fail the run over it
+        print("Warning: cannot write assertion cache {}: {}".format(path, e))
+        return False
+    return True
+
+
+class AssertionCache:
+    """A TTL cache of signed assertion text keyed by assertion type and primary key."""
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL):
+        self.path = path if path is not None else defaultCacheDir()
+        self.ttl = ttl
+
+    def _entryPath(self, assertType, key):
+        if not _VALID_KEY.match(key) or not _VALID_KEY.match(assertType):
+            return None
+        return os.path.join(self.path, assertType, key)
+
+    def get(self, assertType, key):
+        """Return the cached assertion text, or None if missing, expired or invalid."""
+        path = self._entryPath(assertType, key)
+        if path is None:
+            return None
+        try:
+            if time.time() - os.stat(path).st_mtime > self.ttl:
+                return None
+            with open(path) as f:
+                signed = f.read()
+        except OSError:
+            return None
+        if not signed.startswith("type: {}\n".format(assertType)):
+            # not what we stored, drop it so it is fetched again
+            self.invalidate(assertType, key)
+            return None
+        return signed
+
+    def put(self, assertType, key, signed):
+        path = self._entryPath(assertType, key)
+        if path is None:
+            return
+        _writeEntry(path, signed)
+
+    def invalidate(self, assertType, key):
+        path = self._entryPath(assertType, key)
+        if path is None:
+            return
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class SignCache:
+    """A size limited LRU cache of signed assertions keyed by what was signed.
+
+    The use of an entry is recorded in its mtime, so the eviction order
+    carries over between runs. The entries are indexed once per run, on
+    the first put.
+    """
+
+    def __init__(self, path=None, maxSize=DEFAULT_SIGN_CACHE_SIZE):
+        self.path = path if path is not None else defaultCacheDir('signed')
+        self.maxSize = maxSize
+        import threading
+        self._lock = threading.Lock()
+        self._index = None
+        self._size = 0
+
+    @staticmethod
+    def digest(assertJson, key, fingerprint):
+        import hashlib
+        import json
+        content = json.dumps([key, fingerprint, assertJson], sort_keys=True, separators=(',', ':')).encode('utf-8')
+        return hashlib.sha3_384(content).hexdigest()
+
+    def _entryPath(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def get(self, assertJson, key, fingerprint):
+        """Return the cached signed assertion, or None."""
+        path = self._entryPath(self.digest(assertJson, key, fingerprint))
+        try:
+            with open(path) as f:
+                signed = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        if not signed.startswith("type: {}\n".format(assertJson.get('type'))):
+            with self._lock:
+                self._remove(path)
+            return None
+        with self._lock:
+            if self._index is not None and path in self._index:
+                self._index[path] = (time.time(), self._index[path][1])
+        return signed
+
+    def put(self, assertJson, key, fingerprint, signed):
+        path = self._entryPath(self.digest(assertJson, key, fingerprint))
+        if not _writeEntry(path, signed):
+            return
+        with self._lock:
+            if self._index is None:
+                self._load()
+            else:
+                self._size -= self._index.get(path, (0, 0))[1]
+            size = len(signed.encode('utf-8'))
+            self._index[path] = (time.time(), size)
+            self._size += size
+            if self._size > self.maxSize:
+                self._evict()
+
+    def _load(self):
+        self._index = {}
+        self._size = 0
+        for sub in os.scandir(self.path):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.startswith('.tmp-'):
+                    continue
+                stat = entry.stat()
+                self._index[entry.path] = (stat.st_mtime, stat.st_size)
+                self._size += stat.st_size
+
+    def _evict(self):
+        # down to nine tenths of the limit, so not every put evicts
+        target = self.maxSize * 9 // 10
+        for path, _ in sorted(self._index.items(), key=lambda item: item[1][0]):
+            if self._size <= target:
+                break
+            self._remove(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        if self._index is not None and path in self._index:
+            self._size -= self._index.pop(path)[1]
+
+
+def cachedSigner(sign, cache, fingerprint):
+    """Return sign, answering from cache what it signed before with the fingerprint's key.
+
+    Payloads with a password are always signed: their hash has a random
+    salt, so they never repeat.
+    """
+    def signCached(assertJson, key):
+        if 'password' in assertJson:
+            return sign(assertJson, key)
+        signed = cache.get(assertJson, key, fingerprint)
+        if signed is None:
+            signed = sign(assertJson, key)
+            cache.put(assertJson, key, fingerprint, signed)
+        return signed
+    return signCached
@@ -0,0 +1,121 @@
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Password hashing for system-user assertions.
+
+crypt() is CPU bound and holds the GIL, so batch runs hash passwords on a
+pool of processes while the main process waits on the network and on the
+signers.
+"""
+
+import os
+import time
+
+import msu_profile
+
+METHODS = {
+    'sha512': 'METHOD_SHA512',
+    'sha256': 'METHOD_SHA256',
+}
+DEFAULT_METHOD = 'sha512'
+# the rounds crypt accepts for the sha256 and sha512 methods
+MIN_ROUNDS = 1000
+MAX_ROUNDS = 999999999
+
+
+def hashPassword(pword, method=DEFAULT_METHOD, rounds=None):
+    with msu_profile.span('crypt'):
+        return _crypt(pword, method, rounds)
+
+
+def _crypt(pword, method, rounds):
+    # crypt is only imported when a password is hashed
+    import crypt
+    return crypt.crypt(pword, crypt.mksalt(getattr(crypt, METHODS[method]), rounds=rounds))
+
+
+def _timedHash(pword, method, rounds):
+    # runs in a worker process, so the caller records the timing
+    start = time.monotonic()
+    hashed = _crypt(pword, method, rounds)
+    return hashed, start, time.monotonic()
+
+
+class _HashFuture:
+    """The pending hash of one password; records the time a worker spent on it."""
+
+    def __init__(self, future):
+        self._future = future
+        self._recorded = False
+
+    def result(self):
+        hashed, start, end = self._future.result()
+        if not self._recorded:
+            self._recorded = True
+            # time.monotonic() is system wide, so worker times line up with ours
+            msu_profile.record('crypt', start, end, thread='crypt workers')
+        return hashed
+
+
+def defaultWorkers():
+    return os.cpu_count() or 1
+
+
+class HashPool:
+    """A pool of processes hashing passwords with one method and rounds setting."""
+
+    def __init__(self, method=DEFAULT_METHOD, rounds=None, workers=None):
+        self.method = method
+        self.rounds = rounds
+        self.workers = workers if workers else defaultWorkers()
+        from concurrent.futures import ProcessPoolExecutor
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def submit(self, pword):
+        """Queue one password and return a future of its hash."""
+        return _HashFuture(self._executor.submit(_timedHash, pword, self.method, self.rounds))
+
+
+def calibrate(method=DEFAULT_METHOD, rounds=None, workers=None, seconds=1.0):
+    """Measure password hashes per second on this machine.
+
+    :return: a (single process rate, pool rate) tuple in hashes per second.
+    """
+    count = 0
+    start = time.monotonic()
+    while time.monotonic() - start < seconds:
+        hashPassword('calibration', method, rounds)
+        count += 1
+    single = count / (time.monotonic() - start)
+
+    with HashPool(method, rounds, workers) as pool:
+        # warm the workers up so process start is not measured
+        for f in [pool.submit('calibration') for _ in range(pool.workers)]:
+            f.result()
+        total = max(pool.workers, int(single * seconds * pool.workers))
+        start = time.monotonic()
+        for f in [pool.submit('calibration') for _ in range(total)]:
+            f.result()
+        parallel = total / (time.monotonic() - start)
+    return single, parallel
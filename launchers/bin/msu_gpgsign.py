@@ -0,0 +1,348 @@
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+In-process assertion signing through the gpg-agent of the snap keyring.
+
+"snap sign" assembles the assertion text, hashes it with SHA-512 and signs
+the hash with a key from the snap GPG home (~/.snap/gnupg). AgentSigner
+does the same in this process: the key is looked up once with gpg, and
+each assertion is then signed by talking the Assuan protocol to gpg-agent
+over its socket, so no process is started per assertion.
+
+The assertion text and the OpenPGP signature packet are laid out the way
+snapd lays them out, so the output can be used wherever the output of
+"snap sign" can.
+"""
+
+import base64
+import hashlib
+import os
+import re
+import socket
+import struct
+import subprocess
+import threading
+import time
+
+import msu_profile
+from msu_keys import snapGnupgHome
+from msu_sign import SignError
+
+# primary key headers per assertion type, written right after the
+# authority-id and revision like snapd does
+PRIMARY_KEYS = {
+    'system-user': ['brand-id', 'email'],
+}
+
+_PUBKEY_ALGO_RSA = 1
+_HASH_ALGO_SHA512 = 10
+_SIG_TYPE_BINARY = 0x00
+_V1_SIGNATURE_HEADER = b'\x01'
+
+
+def _appendEntry(buf, intro, value, baseIndent):
+    if value is None or (isinstance(value, (list, dict)) and not value):
+        # snapd omits missing and empty values
+        return
+    if isinstance(value, str):
+        buf.append('\n')
+        buf.append(intro)
+        if '\n' in value:
+            # multiline value => quote by indenting
+            pfx = ' ' * (baseIndent + 4)
+            buf.append('\n')
+            buf.append(pfx)
+            value = value.replace('\n', '\n' + pfx)
+        else:
+            buf.append(' ')
+        buf.append(value)
+    elif isinstance(value, list):
+        buf.append('\n')
+        buf.append(intro)
+        pfx = ' ' * baseIndent + '  -'
+        for elem in value:
+            _appendEntry(buf, pfx, elem, baseIndent + 4)
+    elif isinstance(value, dict):
+        buf.append('\n')
+        buf.append(intro)
+        for k in sorted(value):
+            _appendEntry(buf, ' ' * (baseIndent + 2) + k + ':', value[k], baseIndent + 2)
+    else:
+        raise SignError("unsupported header value {!r}".format(value))
+
+
+def assembleContent(assertJson, signKeyId):
+    """Return the assertion text that gets signed, as "snap sign" assembles it."""
+    headers = dict(assertJson)
+    assertType = headers.pop('type', None)
+    if assertType not in PRIMARY_KEYS:
+        raise SignError("cannot sign assertions of type {!r} in-process".format(assertType))
+    body = headers.pop('body', '').encode('utf-8')
+    headers.pop('body-length', None)
+    headers.pop('sign-key-sha3-384', None)
+
+    buf = ['type: ', assertType]
+    written = ['format']
+    try:
+        formatVal = int(headers.get('format', '0'))
+    except ValueError:
+        raise SignError("assertion format {!r} is not an integer".format(headers['format']))
+    if formatVal > 0:
+        # 0 is the default and is not written
+        buf.append('\nformat: {}'.format(formatVal))
+
+    def writeHeader(name):
+        if name in headers:
+            _appendEntry(buf, name + ':', headers[name], 0)
+        written.append(name)
+
+    writeHeader('authority-id')
+    if int(headers.get('revision', '0')) > 0:
+        writeHeader('revision')
+    else:
+        written.append('revision')
+    for name in PRIMARY_KEYS[assertType]:
+        if name not in headers:
+            raise SignError("assertion {} primary key {!r} is missing".format(assertType, name))
+        writeHeader(name)
+    for name in sorted(headers):
+        if name not in written:
+            writeHeader(name)
+    if body:
+        buf.append('\nbody-length: {}'.format(len(body)))
+    buf.append('\nsign-key-sha3-384: ')
+    buf.append(signKeyId)
+
+    content = ''.join(buf).encode('utf-8')
+    if body:
+        content += b'\n\n' + body
+    return content
+
+
+def _mpi(value):
+    n = int.from_bytes(value, 'big')
+    return struct.pack('>H', n.bit_length()) + n.to_bytes((n.bit_length() + 7) // 8, 'big')
+
+
+def _packetHeader(tag, length):
+    # new format packet header
+    header = bytes([0xc0 | tag])
+    if length < 192:
+        return header + bytes([length])
+    if length < 8384:
+        length -= 192
+        return header + bytes([192 + (length >> 8), length & 0xff])
+    return header + b'\xff' + struct.pack('>I', length)
+
+
+def signaturePacket(content, keyId, signHash, created=None):
+    """Return an OpenPGP v4 signature packet over content.
+
+    :param bytes keyId: the 8 byte issuer key id.
+    :param signHash: called with the SHA-512 digest to sign, returns the RSA
+                     signature value as bytes.
+    """
+    if created is None:
+        created = int(time.time())
+    hashed = bytes([5, 2]) + struct.pack('>I', created)
+    unhashed = bytes([9, 16]) + keyId
+    prefix = bytes([4, _SIG_TYPE_BINARY, _PUBKEY_ALGO_RSA, _HASH_ALGO_SHA512]) + struct.pack('>H', len(hashed)) + hashed
+    trailer = b'\x04\xff' + struct.pack('>I', len(prefix))
+    digest = hashlib.sha512(content + prefix + trailer).digest()
+    body = prefix + struct.pack('>H', len(unhashed)) + unhashed + digest[:2] + _mpi(signHash(digest))
+    return _packetHeader(2, len(body)) + body
+
+
+def _percentDecode(data):
+    return re.sub(rb'%([0-9A-Fa-f]{2})', lambda m: bytes([int(m.group(1), 16)]), data)
+
+
+def _parseSexp(data):
+    """Parse a canonical S-expression into nested lists of bytes."""
+    stack = [[]]
+    i = 0
+    while i < len(data):
+        c = data[i:i + 1]
+        if c == b'(':
+            stack.append([])
+            i += 1
+        elif c == b')':
+            done = stack.pop()
+            stack[-1].append(done)
+            i += 1
+        else:
+            colon = data.index(b':', i)
+            length = int(data[i:colon])
+            stack[-1].append(data[colon + 1:colon + 1 + length])
+            i = colon + 1 + length
+    return stack[0][0]
+
+
+def _findValue(sexp, name):
+    if isinstance(sexp, list):
+        if len(sexp) == 2 and sexp[0] == name and isinstance(sexp[1], bytes):
+            return sexp[1]
+        for item in sexp:
+            found = _findValue(item, name)
+            if found is not None:
+                return found
+    return None
+
+
+def _sessionOptions():
+    """Return the OPTION lines gpg sends so that pinentry opens where the user is.
+
+    Keys made by "snap create-key" have a passphrase, and an agent started
+    by another session would otherwise not know which terminal or display
+    to ask it on.
+    """
+    tty = os.environ.get('GPG_TTY')
+    if not tty:
+        try:
+            tty = os.ttyname(0)
+        except OSError:
+            tty = None
+    options = [('ttyname', tty)]
+    for name, variable in (('ttytype', 'TERM'), ('display', 'DISPLAY'), ('xauthority', 'XAUTHORITY')):
+        options.append((name, os.environ.get(variable)))
+    lines = ['OPTION {}={}'.format(name, value) for name, value in options if value]
+    for variable in ('DBUS_SESSION_BUS_ADDRESS', 'WAYLAND_DISPLAY', 'PINENTRY_USER_DATA'):
+        if os.environ.get(variable):
+            lines.append('OPTION putenv={}={}'.format(variable, os.environ[variable]))
+    # a line break would end the command early
+    return [line for line in lines if '\n' not in line and '\r' not in line]
+
+
+class _AgentConnection:
+    """One Assuan connection to gpg-agent."""
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.reader = self.sock.makefile('rb')
+        self._response()
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+    def _response(self):
+        data = b''
+        while True:
+            line = self.reader.readline()
+            if not line:
+                raise SignError("gpg-agent closed the connection")
+            line = line.rstrip(b'\n')
+            if line == b'OK' or line.startswith(b'OK '):
+                return data
+            if line.startswith(b'ERR '):
+                raise SignError("gpg-agent: {}".format(str(line[4:], 'utf-8', 'replace')))
+            if line.startswith(b'D '):
+                data += _percentDecode(line[2:])
+            elif line.startswith(b'INQUIRE '):
+                # nothing to offer, let the agent use its own pinentry
+                self.sock.sendall(b'END\n')
+            # status (S) and comment (#) lines are ignored
+
+    def command(self, line):
+        self.sock.sendall(line.encode('ascii') + b'\n')
+        return self._response()
+
+
+class AgentSigner:
+    """Sign assertions in-process with a key of the snap GPG keyring.
+
+    The instance is called like msu_sign.signAssertion, so it can be used
+    as the sign function of a SignerPool. Each thread gets its own agent
+    connection.
+    """
+
+    def __init__(self, keyName, signKeyId, gnupgHome=None):
+        self.keyName = keyName
+        self.signKeyId = signKeyId
+        self.gnupgHome = gnupgHome if gnupgHome is not None else snapGnupgHome()
+        self.keyId, self.keygrip = self._findKey()
+        self.socketPath = self._agentSocket()
+        self._local = threading.local()
+
+    def _run(self, cmd):
+        try:
+            res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            raise SignError("cannot run {}: {}".format(cmd[0], e))
+        if res.returncode != 0:
+            raise SignError("{} failed: {}".format(' '.join(cmd), str(res.stderr, 'utf-8').strip()))
+        return str(res.stdout, 'utf-8')
+
+    def _findKey(self):
+        out = self._run(['gpg', '--homedir', self.gnupgHome, '--batch', '--no-tty',
+                         '--with-colons', '--with-keygrip', '--fingerprint',
+                         '--list-secret-keys'])
+        keys = []
+        current = None
+        for line in out.splitlines():
+            fields = line.split(':')
+            if fields[0] == 'sec':
+                current = {'algo': fields[3], 'fpr': None, 'grp': None, 'uids': []}
+                keys.append(current)
+            elif fields[0] == 'ssb':
+                # subkeys are not used for assertions
+                current = None
+            elif current is not None and fields[0] in ('fpr', 'grp') and current[fields[0]] is None:
+                current[fields[0]] = fields[9]
+            elif current is not None and fields[0] == 'uid':
+                current['uids'].append(fields[9])
+        for key in keys:
+            if self.keyName in key['uids']:
+                if key['algo'] != str(_PUBKEY_ALGO_RSA):
+                    raise SignError("key '{}' is not an RSA key".format(self.keyName))
+                if not key['fpr'] or not key['grp']:
+                    raise SignError("key '{}' has no keygrip, it is not held by gpg-agent".format(self.keyName))
+                return bytes.fromhex(key['fpr'][-16:]), key['grp']
+        raise SignError("key '{}' is not in the keyring {}".format(self.keyName, self.gnupgHome))
+
+    def _agentSocket(self):
+        self._run(['gpgconf', '--homedir', self.gnupgHome, '--launch', 'gpg-agent'])
+        return self._run(['gpgconf', '--homedir', self.gnupgHome, '--list-dirs', 'agent-socket']).strip()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            try:
+                conn = _AgentConnection(self.socketPath)
+            except OSError as e:
+                raise SignError("cannot connect to gpg-agent at {}: {}".format(self.socketPath, e))
+            for line in _sessionOptions():
+                conn.command(line)
+            self._local.conn = conn
+        return conn
+
+    def _signHash(self, digest):
+        conn = self._connection()
+        conn.command('RESET')
+        conn.command('SIGKEY {}'.format(self.keygrip))
+        conn.command('SETHASH {} {}'.format(_HASH_ALGO_SHA512, digest.hex().upper()))
+        value = _findValue(_parseSexp(conn.command('PKSIGN')), b's')
+        if value is None:
+            raise SignError("gpg-agent returned no RSA signature")
+        return value
+
+    def __call__(self, assertJson, key=None):
+        content = assembleContent(assertJson, self.signKeyId)
+        with msu_profile.span('gpg-agent sign'):
+            packet = signaturePacket(content, self.keyId, self._signHash)
+        signature = base64.b64encode(_V1_SIGNATURE_HEADER + packet)
+        return str(content + b'\n\n' + signature + b'\n', 'utf-8')
+
@@ -0,0 +1,124 @@
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+The completion journal of resumable --manifest runs.
+
+The journal is a JSONL file with one record appended for each row whose
+assertion files were written: the row, username, serials, output paths,
+their size and the SHA3-384 of their content, and the id of the row. The
+id is a hash of the row's fields and of the settings that decide where it
+is written and what it holds: the brand, model, key, layout, output
+directory, since and password hashing options. A row that was edited, or
+a run with other settings, is signed again.
+Passwords are not part of the id, as an unsalted hash of one would be
+written to the journal: a row whose only change is its password is not
+signed again until its record is removed.
+
+A rerun with the same journal skips the rows that have a record and whose
+files still exist with the recorded size, so it only costs the reading of
+the journal and a stat per skipped file. A record cut short by a crash
+is ignored and its row is signed again.
+"""
+
+import hashlib
+import json
+import os
+
+# the row fields that decide the content of its assertion
+ID_FIELDS = ('row', 'username', 'email', 'ssh_keys', 'serials', 'until', 'force_password_change')
+
+
+def rowId(user, settings):
+    """Return the id of a manifest row signed with settings."""
+    fields = {name: user[name] for name in ID_FIELDS}
+    fields['password'] = user['password'] is not None
+    fields['settings'] = settings
+    content = json.dumps(fields, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return hashlib.sha3_256(content).hexdigest()
+
+
+def contentHash(parts):
+    """Return the SHA3-384 of an output written as the parts separated by newlines."""
+    digest = hashlib.sha3_384()
+    for i, part in enumerate(parts):
+        if i:
+            digest.update(b"\n")
+        digest.update(part.encode('utf-8'))
+    return 'sha3-384:' + digest.hexdigest()
+
+
+class Journal:
+    """Records of the completed rows, appended to path as they complete."""
+
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = settings
+        self._records = {}
+        line = ''
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        self._records[record['id']] = record
+                    except (ValueError, TypeError, KeyError):
+                        # the last record may be cut short by a crash
+                        continue
+            complete = line.endswith("\n")
+        except FileNotFoundError:
+            complete = True
+        self._file = open(path, 'a')
+        if not complete:
+            # end the cut short record, so the next one starts on its own line
+            self._file.write("\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def done(self, user):
+        """Return whether the row was completed and its files are still there."""
+        record = self._records.get(rowId(user, self.settings))
+        if record is None:
+            return False
+        for path in record['paths']:
+            try:
+                if os.stat(path).st_size != record['size']:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def record(self, user, paths, parts):
+        """Append the record of a row whose files were written to paths."""
+        size = sum(len(part.encode('utf-8')) for part in parts) + len(parts) - 1
+        record = {
+            'id': rowId(user, self.settings),
+            'row': user['row'],
+            'username': user['username'],
+            'serials': user['serials'],
+            'paths': paths,
+            'size': size,
+            'content': contentHash(parts),
+        }
+        self._records[record['id']] = record
+        self._file.write(json.dumps(record, sort_keys=True) + "\n")
+        # flushed, so a crash loses at most the record being written
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
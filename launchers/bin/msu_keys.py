@@ -0,0 +1,126 @@
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Name to fingerprint indexes of the local and the store registered keys.
+
+The local index is built once per process from "snap keys --json". It is
+also kept on disk and reused as long as the snap GPG keyring has not been
+modified since, so most runs do not need to run "snap keys" at all.
+"""
+
+import json
+import os
+import subprocess
+import tempfile
+
+import msu_profile
+
+# files of the keyring that change when a key is created or imported
+_KEYRING_FILES = ['pubring.kbx', 'pubring.gpg', 'secring.gpg', 'private-keys-v1.d']
+
+_localKeys = None
+_storeKeys = {}
+
+
+def snapGnupgHome():
+    return os.environ.get('SNAP_GNUPG_HOME', os.path.join(os.path.expanduser('~'), '.snap', 'gnupg'))
+
+
+def keyringMtime(home=None):
+    """Return the latest modification time of the snap keyring, or None if there is none."""
+    home = home if home is not None else snapGnupgHome()
+    mtimes = []
+    for name in [''] + _KEYRING_FILES:
+        try:
+            mtimes.append(os.stat(os.path.join(home, name)).st_mtime_ns)
+        except OSError:
+            pass
+    return max(mtimes) if mtimes else None
+
+
+def _cachePath():
+    from xdg import BaseDirectory
+    return os.path.join(BaseDirectory.save_cache_path('make-system-user'), 'keys.json')
+
+
+def parseSnapKeys(output):
+    """Return a name to fingerprint dict from "snap keys" output, JSON or plain."""
+    output = output.strip()
+    if output.startswith('['):
+        return {k['name']: k['sha3-384'] for k in json.loads(output)}
+    keys = {}
+    # plain output is a "Name  SHA3-384" header followed by one key per line
+    for line in output.split('\n')[1:]:
+        fields = line.split()
+        if len(fields) == 2:
+            keys[fields[0]] = fields[1]
+    return keys
+
+
+def _runSnapKeys():
+    with msu_profile.span('snap keys'):
+        res = subprocess.run(['snap', 'keys', '--json'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if res.returncode != 0:
+            # older snapd without --json
+            res = subprocess.run(['snap', 'keys'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return parseSnapKeys(str(res.stdout, 'utf-8'))
+
+
+def _readDiskCache(mtime):
+    try:
+        with open(_cachePath()) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get('home') != snapGnupgHome() or cached.get('mtime') != mtime:
+        return None
+    return cached.get('keys')
+
+
+def _writeDiskCache(mtime, keys):
+    path = _cachePath()
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'home': snapGnupgHome(), 'mtime': mtime, 'keys': keys}, f)
+        os.replace(tmp, path)
+    except OSError:
+        # the cache is an optimization only
+        pass
+
+
+def localKeys(diskCache=True):
+    """Return the name to fingerprint dict of the keys in the snap keyring."""
+    global _localKeys
+    if _localKeys is not None:
+        return _localKeys
+    mtime = keyringMtime() if diskCache else None
+    keys = _readDiskCache(mtime) if mtime is not None else None
+    if keys is None:
+        keys = _runSnapKeys()
+        if mtime is not None:
+            _writeDiskCache(mtime, keys)
+    _localKeys = keys
+    return keys
+
+
+def storeKeys(account):
+    """Return the name to fingerprint dict of the keys registered to the account."""
+    accountId = account.get('account_id')
+    keys = _storeKeys.get(accountId)
+    if keys is None:
+        keys = {k['name']: k['public-key-sha3-384'] for k in account.get('account_keys', [])}
+        _storeKeys[accountId] = keys
+    return keys
@@ -0,0 +1,143 @@
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Reading of device manifests for batch mode.
+
+A manifest is either a CSV file with a header row or a JSONL file with one
+JSON object per line. Each row describes one system user to create:
+
+    username, email, password, ssh-keys, serials, until, force-password-change
+
+In CSV files the list fields (ssh-keys and serials) are delimited with ";".
+In JSONL files they may be given as JSON lists or as ";" delimited strings.
+"""
+
+import csv
+import json
+
+FIELDS = ('username', 'email', 'password', 'ssh-keys', 'serials', 'until', 'force-password-change')
+LIST_DELIMITER = ';'
+
+
+class ManifestError(Exception):
+    def __init__(self, row, message):
+        self.row = row
+        self.message = message
+        super().__init__("row {}: {}".format(row, message))
+
+
+def _listField(value):
+    if value is None:
+        return None
+    if isinstance(value, list):
+        items = [str(v).strip() for v in value]
+    else:
+        items = [v.strip() for v in str(value).split(LIST_DELIMITER)]
+    items = [v for v in items if v]
+    return items if items else None
+
+
+def _boolField(value):
+    if isinstance(value, bool):
+        return value
+    if value is None:
+        return False
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y')
+
+
+def _strField(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value if value else None
+
+
+def normalizeRow(row, raw):
+    """Return a user dict from the raw manifest fields of one row.
+
+    The keys match the attribute names of the command line arguments, so a
+    row can be used wherever the single user arguments are used.
+    """
+    unknown = [k for k in raw if k not in FIELDS]
+    if unknown:
+        raise ManifestError(row, "unknown field(s): {}".format(", ".join(sorted(unknown))))
+    user = {
+        'row': row,
+        'username': _strField(raw.get('username')),
+        'email': _strField(raw.get('email')),
+        'password': _strField(raw.get('password')),
+        'ssh_keys': _listField(raw.get('ssh-keys')),
+        'serials': _listField(raw.get('serials')),
+        'until': _strField(raw.get('until')),
+        'force_password_change': _boolField(raw.get('force-password-change')),
+    }
+    if user['username'] is None:
+        raise ManifestError(row, "username is required")
+    if user['email'] is None:
+        raise ManifestError(row, "email is required")
+    return user
+
+
+def _readCsv(f):
+    reader = csv.DictReader(f)
+    # the header is row 1, so data rows start at 2
+    for row, raw in enumerate(reader, start=2):
+        yield row, {k.strip(): v for k, v in raw.items() if k is not None}
+
+
+def _readJsonl(f):
+    for row, line in enumerate(f, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            raw = json.loads(line)
+        except ValueError as e:
+            yield row, ManifestError(row, "invalid JSON: {}".format(e))
+            continue
+        if not isinstance(raw, dict):
+            yield row, ManifestError(row, "expected a JSON object")
+            continue
+        yield row, raw
+
+
+def _rows(path):
+    """Yield a user dict or a ManifestError for every manifest row."""
+    with open(path, newline='') as f:
+        reader = _readJsonl if path.endswith('.jsonl') or path.endswith('.json') else _readCsv
+        for row, raw in reader(f):
+            if isinstance(raw, ManifestError):
+                yield raw
+                continue
+            try:
+                yield normalizeRow(row, raw)
+            except ManifestError as e:
+                yield e
+
+
+def loadManifest(path):
+    """Return (users, errors): a user dict per row and a ManifestError per row that cannot be read.
+
+    Files ending in ".jsonl" or ".json" are read as JSONL, anything else as
+    CSV. Reading goes on past bad rows, so all of them are reported at once.
+    """
+    users = []
+    errors = []
+    for user in _rows(path):
+        if isinstance(user, ManifestError):
+            errors.append(user)
+        else:
+            users.append(user)
+    return users, errors
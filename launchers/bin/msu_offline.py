@@ -0,0 +1,111 @@
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Offline files, for signing system-user assertions without network access.
+
+An offline file is written once on a machine that can reach the store, with
+--export-offline. It holds what the login and pre-flight steps fetch: the
+account info, the name and fingerprint of the signing key, and the signed
+account and account-key assertions. A machine without network access then
+signs with --offline FILE and the same key in its local snap keyring.
+
+The file is JSON. Its "digest" is the SHA3-384 of the other fields,
+serialized with sorted keys, so a damaged or truncated file is refused.
+The digest is not keyed and detects damage only: anyone who edits the
+file can compute it again, so keep the file where only trusted users can
+write it. No Ubuntu SSO credentials are stored: the signing machine
+never needs them.
+"""
+
+import hashlib
+import json
+import time
+
+import msu_output
+
+FORMAT = 'make-system-user-offline'
+VERSION = 1
+
+
+class OfflineError(Exception):
+    pass
+
+
+def _digest(data):
+    content = json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    return 'sha3-384:' + hashlib.sha3_384(content).hexdigest()
+
+
+def _header(signed, name):
+    """Return the value of a header of a signed assertion, or None."""
+    prefix = name + ': '
+    for line in signed.split('\n'):
+        if not line:
+            # the headers end at the first empty line
+            break
+        if line.startswith(prefix):
+            return line[len(prefix):].strip()
+    return None
+
+
+def check(data):
+    """Raise OfflineError unless data is a complete and consistent offline file."""
+    if data.get('format') != FORMAT:
+        raise OfflineError("not a make-system-user offline file")
+    if data.get('version') != VERSION:
+        raise OfflineError("unsupported offline file version {}".format(data.get('version')))
+    content = {k: v for k, v in data.items() if k != 'digest'}
+    if data.get('digest') != _digest(content):
+        raise OfflineError("the digest does not match, the file is damaged")
+    account = data.get('account') or {}
+    if _header(data.get('account-assertion', ''), 'account-id') != account.get('account_id'):
+        raise OfflineError("the account assertion is not for account {}".format(account.get('account_id')))
+    if _header(data.get('account-key-assertion', ''), 'public-key-sha3-384') != data.get('fingerprint'):
+        raise OfflineError("the account-key assertion is not for key {}".format(data.get('fingerprint')))
+
+
+def export(path, account, key, fingerprint, accountSigned, accountKeySigned):
+    """Write the offline file for signing with key to path."""
+    data = {
+        'format': FORMAT,
+        'version': VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'account': account,
+        'key': key,
+        'fingerprint': fingerprint,
+        'account-assertion': accountSigned,
+        'account-key-assertion': accountKeySigned,
+    }
+    data['digest'] = _digest(data)
+    check(data)
+    msu_output.atomicWrite(path, [json.dumps(data, indent=2, sort_keys=True) + "\n"])
+
+
+def load(path):
+    """Return the checked contents of the offline file at path.
+
+    :raises OfflineError: if the file cannot be read or fails the checks.
+    """
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except OSError as e:
+        raise OfflineError(e.strerror)
+    except ValueError as e:
+        raise OfflineError("invalid JSON: {}".format(e))
+    if not isinstance(data, dict):
+        raise OfflineError("not a make-system-user offline file")
+    check(data)
+    return data
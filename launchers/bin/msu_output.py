@@ -0,0 +1,137 @@
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Writers for the signed auto-import.assert files.
+
+An auto-import.assert file is the account assertion, the account-key
+assertion and the system-user assertion, separated by newlines. Writers
+take the parts of each file as soon as it is signed and write them out
+without joining them, so a run never holds more than one output at a time.
+
+All files are written to a temporary file that is renamed into place, so
+an interrupted run never leaves a partial file behind.
+"""
+
+import io
+import os
+import time
+
+FILENAME = "auto-import.assert"
+LAYOUTS = ['flat', 'per-serial']
+
+
+def fileMode():
+    # mkstemp creates files readable by the owner only, use what open() would
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def atomicWrite(path, parts):
+    """Write the parts, separated by newlines, to path through a temporary file."""
+    import tempfile
+    directory = os.path.dirname(path) or '.'
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        os.chmod(tmp, fileMode())
+        with os.fdopen(fd, 'w') as out:
+            for i, part in enumerate(parts):
+                if i:
+                    out.write("\n")
+                out.write(part)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def entryNames(user, layout):
+    """Return the relative paths the output of one manifest row is written to."""
+    if layout == 'per-serial':
+        if user['serials']:
+            return [os.path.join(serial, FILENAME) for serial in user['serials']]
+        return [os.path.join("{:06d}-{}".format(user['row'], user['username']), FILENAME)]
+    return ["{:06d}-{}.{}".format(user['row'], user['username'], FILENAME)]
+
+
+class DirectoryWriter:
+    """Write each output as a file below a directory."""
+
+    def __init__(self, path, layout='flat'):
+        self.path = path
+        self.layout = layout
+        os.makedirs(path, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, user, parts):
+        for name in entryNames(user, self.layout):
+            path = os.path.join(self.path, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomicWrite(path, parts)
+
+    def close(self):
+        pass
+
+
+class TarWriter:
+    """Append each output as an entry of a tar archive.
+
+    The archive is written to a temporary file next to path and only
+    renamed to path once it is complete.
+    """
+
+    def __init__(self, path, layout='flat'):
+        import tarfile
+        import tempfile
+        self.path = path
+        self.layout = layout
+        fd, self._tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp-')
+        os.chmod(self._tmp, fileMode())
+        self._file = os.fdopen(fd, 'wb')
+        self._tar = tarfile.open(fileobj=self._file, mode='w')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        if excType is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, user, parts):
+        import tarfile
+        data = "\n".join(parts).encode('utf-8')
+        for name in entryNames(user, self.layout):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            info.mode = 0o644
+            self._tar.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self._tar.close()
+        self._file.close()
+        os.replace(self._tmp, self.path)
+
+    def abort(self):
+        self._tar.close()
+        self._file.close()
+        os.unlink(self._tmp)
@@ -0,0 +1,156 @@
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Per-phase timing of a run, enabled with --profile.
+
+Phases are recorded as nested spans on the monotonic clock, from any
+thread. When profiling is off, span() costs a global lookup.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+_profiler = None
+
+
+class Profiler:
+    def __init__(self, path=None, format='json'):
+        self.path = path
+        self.format = format
+        self.started = time.monotonic()
+        self.spans = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def record(self, name, start, end, thread=None, depth=0, **args):
+        with self._lock:
+            self.spans.append({
+                'name': name,
+                'start': start,
+                'end': end,
+                'thread': thread if thread is not None else threading.current_thread().name,
+                'depth': depth,
+                'args': args,
+            })
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            self.record(name, start, time.monotonic(), depth=depth, **args)
+
+    def summary(self):
+        """Return (name, count, total, p50, p95, p99) per phase, in seconds, in first seen order."""
+        from http_clients import percentile
+        phases = {}
+        with self._lock:
+            for s in self.spans:
+                phases.setdefault(s['name'], []).append(s['end'] - s['start'])
+        rows = []
+        for name, durations in phases.items():
+            durations.sort()
+            rows.append((name, len(durations), sum(durations),
+                         percentile(durations, 50), percentile(durations, 95), percentile(durations, 99)))
+        return rows
+
+    def printSummary(self):
+        rows = self.summary()
+        if not rows:
+            return
+        batch = any(row[1] > 1 for row in rows)
+        width = max(len(row[0]) for row in rows)
+        header = "{:<{w}} {:>7} {:>11}".format("phase", "count", "total ms", w=width)
+        if batch:
+            header += " {:>9} {:>9} {:>9}".format("p50 ms", "p95 ms", "p99 ms")
+        print("==== Profile:")
+        print(header)
+        for name, count, total, p50, p95, p99 in rows:
+            line = "{:<{w}} {:>7} {:>11.1f}".format(name, count, total * 1000, w=width)
+            if batch:
+                line += " {:>9.1f} {:>9.1f} {:>9.1f}".format(p50 * 1000, p95 * 1000, p99 * 1000)
+            print(line)
+
+    def write(self, path=None, format=None):
+        path = path or self.path
+        format = format or self.format
+        with self._lock:
+            spans = list(self.spans)
+        if format == 'chrome':
+            threads = {}
+            events = []
+            for s in spans:
+                tid = threads.setdefault(s['thread'], len(threads) + 1)
+                events.append({
+                    'name': s['name'], 'cat': 'msu', 'ph': 'X',
+                    'ts': s['start'] * 1e6, 'dur': (s['end'] - s['start']) * 1e6,
+                    'pid': os.getpid(), 'tid': tid, 'args': s['args'],
+                })
+            for thread, tid in threads.items():
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                               'args': {'name': thread}})
+            data = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        else:
+            data = {'spans': spans}
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=1)
+
+
+def enable(path=None, format='json'):
+    global _profiler
+    _profiler = Profiler(path, format)
+    return _profiler
+
+
+def active():
+    """Return the profiler of this run, or None when profiling is off."""
+    return _profiler
+
+
+def finish():
+    """Print the summary of the run and write the profile file, once."""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is None:
+        return
+    profiler.record('run', profiler.started, time.monotonic())
+    profiler.printSummary()
+    if profiler.path:
+        try:
+            profiler.write()
+        except OSError as e:
+            print("Error: cannot write the profile to {}: {}".format(profiler.path, e))
+            return
+        print("Profile written to {}.".format(profiler.path))
+
+
+def span(name, **args):
+    """Return a context manager timing one phase, or a no-op when profiling is off."""
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.span(name, **args)
+
+
+def record(name, start, end, thread=None, **args):
+    """Record a phase measured elsewhere, for example in a worker process."""
+    if _profiler is not None:
+        _profiler.record(name, start, end, thread=thread, **args)
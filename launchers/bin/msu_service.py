@@ -0,0 +1,258 @@
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+A local HTTP service that signs system-user assertions on request.
+
+The service is started after the login and pre-flight steps, so every
+request only builds and signs one assertion. It listens on a unix socket
+("unix:/path/to/socket") or on a loopback TCP address ("host:port") and
+serves:
+
+    POST /sign   body: one manifest row as a JSON object
+                 returns the auto-import.assert content as text/plain
+    GET /stats   returns request counts, requests per second and
+                 latency percentiles as JSON
+
+At most queueSize requests are accepted at once; more get a 503 response.
+
+Requests are not authenticated: whoever can connect gets assertions signed
+with the brand key. The unix socket is only open to the user running the
+service, while a TCP address is open to every user of the machine, so TCP
+is limited to loopback addresses and never listens on the network.
+"""
+
+import collections
+import ipaddress
+import json
+import os
+import signal
+import socketserver
+import stat
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from http_clients import percentile
+
+# number of latencies kept for the percentiles
+LATENCY_WINDOW = 10000
+
+
+class ServiceError(Exception):
+    """The service cannot listen on the address it was given."""
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(message)
+
+
+class RequestError(Exception):
+    """A request that cannot be served, with the HTTP status to answer."""
+
+    def __init__(self, status, message):
+        self.status = status
+        self.message = message
+        super().__init__(message)
+
+
+class Stats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+
+    def record(self, seconds, ok):
+        with self._lock:
+            self.requests += 1
+            if not ok:
+                self.errors += 1
+            self.latencies.append(seconds)
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def snapshot(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+            uptime = time.monotonic() - self.started
+            result = {
+                'uptime': uptime,
+                'requests': self.requests,
+                'errors': self.errors,
+                'rejected': self.rejected,
+                'requests_per_second': self.requests / uptime if uptime > 0 else 0,
+            }
+        for p in (50, 95, 99):
+            value = percentile(latencies, p)
+            result['latency_p{}_ms'.format(p)] = value * 1000 if value is not None else None
+        return result
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "make-system-user"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            print("service: " + format % args)
+
+    def _reply(self, status, body, contentType='text/plain; charset=utf-8'):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self._reply(404, "not found\n")
+            return
+        self._reply(200, json.dumps(self.server.stats.snapshot(), indent=2) + "\n", 'application/json')
+
+    def do_POST(self):
+        if self.path != '/sign':
+            self._reply(404, "not found\n")
+            return
+        if not self.server.slots.acquire(blocking=False):
+            self.server.stats.reject()
+            self._reply(503, "too many requests in progress\n")
+            return
+        start = time.monotonic()
+        ok = False
+        try:
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+            except ValueError:
+                length = -1
+            if length < 0:
+                raise RequestError(400, "invalid Content-Length")
+            try:
+                row = json.loads(self.rfile.read(length).decode('utf-8'))
+            except ValueError as e:
+                raise RequestError(400, "invalid JSON: {}".format(e))
+            if not isinstance(row, dict):
+                raise RequestError(400, "expected a JSON object")
+            content = self.server.sign(row)
+            ok = True
+            self._reply(200, content)
+        except RequestError as e:
+            self._reply(e.status, e.message + "\n")
+        except Exception as e:
+            self._reply(500, "{}\n".format(e))
+        finally:
+            self.server.stats.record(time.monotonic() - start, ok)
+            self.server.slots.release()
+
+
+class _TCPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # http.server expects a (host, port) client address
+        return request, ('unix', 0)
+
+
+def _tcpAddress(address):
+    host, _, port = address.rpartition(':')
+    host = host or '127.0.0.1'
+    try:
+        port = int(port)
+    except ValueError:
+        raise ServiceError("{!r} is not a HOST:PORT address".format(address))
+    if not 0 <= port <= 65535:
+        raise ServiceError("the port {} is out of range".format(port))
+    try:
+        loopback = host == 'localhost' or ipaddress.IPv4Address(host).is_loopback
+    except ValueError:
+        loopback = False
+    if not loopback:
+        raise ServiceError("{} is not a loopback address: requests are not authenticated, so the service only listens on loopback addresses such as 127.0.0.1".format(host))
+    return host, port
+
+
+def _removeStaleSocket(path):
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise ServiceError("{} exists and is not a socket".format(path))
+    os.unlink(path)
+
+
+def checkAddress(address):
+    """Return an error message if the service cannot listen on address, else None."""
+    try:
+        if address.startswith('unix:'):
+            path = address[len('unix:'):]
+            if os.path.lexists(path) and not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise ServiceError("{} exists and is not a socket".format(path))
+        else:
+            _tcpAddress(address)
+    except ServiceError as e:
+        return e.message
+    return None
+
+
+def makeServer(address, sign, queueSize, verbose=False):
+    """Return a server for address that answers /sign requests with sign(row).
+
+    :raises ServiceError: if address cannot be used.
+    """
+    if address.startswith('unix:'):
+        path = address[len('unix:'):]
+        _removeStaleSocket(path)
+        server = _UnixServer(path, _Handler)
+        # only the user running the service may ask for signatures
+        os.chmod(path, 0o600)
+        server.socketPath = path
+    else:
+        server = _TCPServer(_tcpAddress(address), _Handler)
+        server.socketPath = None
+    server.sign = sign
+    server.slots = threading.BoundedSemaphore(queueSize)
+    server.stats = Stats()
+    server.verbose = verbose
+    return server
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def serve(server):
+    """Serve until interrupted or terminated, then print the final stats."""
+    signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if server.socketPath:
+            try:
+                os.unlink(server.socketPath)
+            except OSError:
+                pass
+    print(json.dumps(server.stats.snapshot(), indent=2))
@@ -0,0 +1,102 @@
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Signing of assertions with "snap sign".
+
+SignerPool keeps a fixed set of worker threads for the whole run. Each
+worker feeds the assertion JSON to "snap sign" on stdin, without a shell,
+so several gpg signing operations run on separate cores at once.
+"""
+
+import collections
+import json
+import os
+
+import msu_profile
+
+
+class SignError(Exception):
+    pass
+
+
+SignResult = collections.namedtuple('SignResult', ['job', 'signed', 'error'])
+
+
+def signAssertion(assertJson, key):
+    """Return the assertion signed by "snap sign" with the named key.
+
+    :raises SignError: if snap sign fails.
+    """
+    import subprocess
+    with msu_profile.span('snap sign'):
+        res = subprocess.run(
+            ['snap', 'sign', '-k', key],
+            input=json.dumps(assertJson).encode('utf-8'),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    if res.returncode != 0:
+        raise SignError(str(res.stderr, 'utf-8').strip() or "snap sign exited with status {}".format(res.returncode))
+    return str(res.stdout, 'utf-8')
+
+
+def defaultWorkers():
+    return os.cpu_count() or 1
+
+
+class SignerPool:
+    """A fixed size pool of workers signing assertions with one key."""
+
+    def __init__(self, key, workers=None, sign=signAssertion):
+        self.key = key
+        self.workers = workers if workers else defaultWorkers()
+        self._sign = sign
+        from concurrent.futures import ThreadPoolExecutor
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def submit(self, assertJson):
+        """Queue one assertion and return a future of its signed text."""
+        return self._executor.submit(self._sign, assertJson, self.key)
+
+    def signAll(self, jobs):
+        """Sign (job, assertJson) pairs and yield a SignResult per job in input order.
+
+        A failing job is reported in its result's error and does not stop the
+        others. At most twice the number of workers are queued at once, so
+        the jobs iterable is consumed lazily and memory use stays bounded.
+        """
+        pending = collections.deque()
+        for job, assertJson in jobs:
+            pending.append((job, self.submit(assertJson)))
+            if len(pending) >= 2 * self.workers:
+                yield self._result(*pending.popleft())
+        while pending:
+            yield self._result(*pending.popleft())
+
+    @staticmethod
+    def _result(job, future):
+        try:
+            return SignResult(job, future.result(), None)
+        except Exception as e:
+            return SignResult(job, None, e)
@@ -0,0 +1,133 @@
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Checks of the users to sign, done before the login and any store request.
+
+Every user, from the command line, a manifest row or a --serve request, is
+checked here for what snapd or the signing would reject later: the
+username and email, the ssh key format, the until date, the serials and
+the combination of authentication settings. The patterns are compiled
+once and the since date is computed once per pass, so checking a manifest
+costs a few microseconds per row and reports every problem at once.
+"""
+
+import os
+import re
+from datetime import datetime, timedelta
+
+# as snapd checks system-user usernames
+USERNAME = re.compile(r'^[a-z0-9][-a-z0-9+._]*$')
+EMAIL = re.compile(r'^[^@\s]+@[^@\s]+$')
+# an authorized_keys line: options, such as from="10.0.0.0/8", then the
+# key type, plain or a certificate, the base64 key and a comment
+_SSH_OPTION = r'[A-Za-z0-9-]+(?:="(?:[^"\\]|\\.)*")?'
+SSH_KEY = re.compile(
+    r'^(?:' + _SSH_OPTION + r'(?:,' + _SSH_OPTION + r')* +)?'
+    r'(?:(?:ssh-(?:rsa|dss|ed25519)|ecdsa-sha2-nistp(?:256|384|521))(?:-cert-v01@openssh\.com)?'
+    r'|sk-(?:ssh-ed25519|ecdsa-sha2-nistp256)(?:-cert-v01)?@openssh\.com)'
+    r' [A-Za-z0-9+/]+={0,3}(?: .*)?$')
+UNTIL = re.compile(r'^(\d{4}):(\d{1,2}):(\d{1,2})$')
+
+
+def sinceLimit(since_days_ago, now=None):
+    """Return the time the until dates must be after."""
+    if now is None:
+        now = datetime.now()
+    return now - timedelta(days=int(since_days_ago))
+
+
+def checkAuth(user):
+    """Return an error message if the user's authentication settings conflict, else None."""
+    if user['password'] is None and user['ssh_keys'] is None:
+        return "You must supply either a password or public SSH keys(s)."
+    if user['password'] is not None and user['ssh_keys'] is not None:
+        return "You cannot use both a password and an ssh key."
+    if user['force_password_change'] and user['password'] is None:
+        return "Using --force-password-change also requires --password."
+    if user['force_password_change'] and user['ssh_keys'] is not None:
+        return "Using --force-password-change with --ssh-keys is not allowed."
+    return None
+
+
+def checkUntil(until, since):
+    """Return an error message if until is not a YYYY:MM:DD date after since, else None."""
+    if until is None:
+        return None
+    match = UNTIL.match(until)
+    try:
+        if match is None:
+            raise ValueError(until)
+        untildt = datetime(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+    except ValueError:
+        return "The until date must be given as YYYY:MM:DD, not {}.".format(until)
+    if since >= untildt:
+        return "The until date {} is not after the since date.".format(until)
+    return None
+
+
+def checkUser(user, since):
+    """Return the error messages for one user, an empty list if it can be signed."""
+    errors = []
+    if not USERNAME.match(user['username'] or ''):
+        errors.append("The username {!r} is not valid: use lowercase letters, digits and -+._, starting with a letter or digit.".format(user['username']))
+    if not EMAIL.match(user['email'] or ''):
+        errors.append("The email {!r} is not a valid email address.".format(user['email']))
+    for key in user['ssh_keys'] or ():
+        if not SSH_KEY.match(key):
+            errors.append("The ssh key {!r} is not a public key: it must be the key type, such as ssh-rsa or ssh-ed25519, followed by the base64 key, optionally after authorized_keys options.".format(key[:40]))
+    error = checkAuth(user)
+    if error:
+        errors.append(error)
+    error = checkUntil(user['until'], since)
+    if error:
+        errors.append(error)
+    serials = user['serials'] or ()
+    for serial in serials:
+        # serials name the output files of the per-serial layout
+        if serial in ('', '.', '..') or os.sep in serial or '/' in serial:
+            errors.append("The serial {!r} cannot be used as a file name.".format(serial))
+    if len(set(serials)) != len(serials):
+        seen = set()
+        for serial in serials:
+            if serial in seen:
+                errors.append("The serial {} is given more than once.".format(serial))
+            seen.add(serial)
+    return errors
+
+
+def serialKeys(user):
+    return user['serials'] or []
+
+
+def checkUsers(users, since, uniqueKeys=None):
+    """Return (row, message) for every problem of the users.
+
+    uniqueKeys(user), when given, returns the names that must not be used
+    by two users, such as the serials of a per-serial output layout.
+    """
+    errors = []
+    owners = {}
+    for user in users:
+        row = user['row']
+        for message in checkUser(user, since):
+            errors.append((row, message))
+        if uniqueKeys is None:
+            continue
+        for key in set(uniqueKeys(user)):
+            if key in owners:
+                errors.append((row, "{} is also used by row {}, the output needs unique serials.".format(key, owners[key])))
+            else:
+                owners[key] = row
+    return errors
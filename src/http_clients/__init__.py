@@ -19,5 +19,21 @@ from typing import Union
 from . import errors  # noqa: F401
 from ._ubuntu_sso_client import UbuntuOneAuthClient  # noqa: F401
 from ._http_client import Client  # noqa: F401
+from ._metrics import RequestMetrics, percentile  # noqa: F401
+from ._tracing import set_tracer  # noqa: F401
 
 
+# The asyncio clients need aiohttp, only import them when they are used.
+_ASYNC_CLIENTS = {
+    "AsyncClient": "._async_http_client",
+    "AsyncUbuntuOneAuthClient": "._async_ubuntu_sso_client",
+}
+
+
+def __getattr__(name):
+    if name in _ASYNC_CLIENTS:
+        import importlib
+
+        module = importlib.import_module(_ASYNC_CLIENTS[name], __name__)
+        return getattr(module, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,204 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2021 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import Optional
+
+import aiohttp
+import simplejson
+
+from . import errors
+from ._http_client import IDEMPOTENT_METHODS, STATUS_FORCELIST
+from ._metrics import RequestMetrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class Response:
+    """A fully read response with the attributes of a requests.Response."""
+
+    def __init__(self, response: aiohttp.ClientResponse, content: bytes) -> None:
+        self.status_code = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.url = str(response.url)
+        self.content = content
+        self.encoding = response.get_encoding() if content else "utf-8"
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding, errors="replace")
+
+    def json(self):
+        return simplejson.loads(self.text)
+
+
+class AsyncClient:
+    """Generic asyncio Client to talk to the *Store.
+
+    Connections are kept in a pool of at most pool_size connections, so
+    many requests can be in flight at once without opening a connection
+    per request.
+    """
+
+    def __init__(
+        self, *, user_agent: str = "make-system-user", pool_size: Optional[int] = None
+    ) -> None:
+        self._user_agent = user_agent
+        self._pool_size = (
+            pool_size
+            if pool_size is not None
+            else int(os.environ.get("STORE_POOL_SIZE", 10))
+        )
+        self._retries = int(os.environ.get("STORE_RETRIES", 5))
+        self._backoff = int(os.environ.get("STORE_BACKOFF", 2))
+        self._jitter = float(os.environ.get("STORE_JITTER", 0.5))
+        # Overall time budget of one request, retries included.
+        self.deadline = float(os.environ.get("STORE_DEADLINE", 60))
+        self.metrics = RequestMetrics()
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # The session binds to the running loop, so create it on first use.
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self._pool_size)
+            )
+        return self._session
+
+    def _backoff_time(self, attempt: int, response: Optional[Response]) -> float:
+        if response is not None and response.headers.get("Retry-After"):
+            try:
+                return max(float(response.headers["Retry-After"]), 0)
+            except ValueError:
+                pass
+        # Same schedule as DeadlineRetry used by the blocking Client.
+        if attempt == 0:
+            return 0
+        return self._backoff * (2 ** attempt) * (1 - self._jitter * random.random())
+
+    async def request(
+        self, method, url, params=None, headers=None, **kwargs
+    ) -> Response:
+        """Send a request to url relative to the root url.
+
+        :param str method: Method used for the request.
+        :param str url: URL to request with method.
+        :param list params: Query parameters to be sent along with the request.
+        :param list headers: Headers to be sent along with the request.
+
+        :return Response of the request.
+        """
+        if headers:
+            headers["User-Agent"] = self._user_agent
+        else:
+            headers = {"User-Agent": self._user_agent}
+
+        debug_headers = headers.copy()
+        if debug_headers.get("Authorization"):
+            debug_headers["Authorization"] = "<macaroon>"
+        if debug_headers.get("Macaroons"):
+            debug_headers["Macaroons"] = "<macaroon>"
+        logger.debug(
+            "Calling {} with params {} and headers {}".format(
+                url, params, debug_headers
+            )
+        )
+
+        session = self._get_session()
+        # As the blocking Client: only idempotent requests are sent again,
+        # other ones only when the connection could not be made at all.
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        start = time.monotonic()
+        deadline = start + self.deadline
+        attempt = 0
+        while True:
+            response = None
+            error = None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # aiohttp would take a timeout of 0 as no timeout at all.
+                self.metrics.record(method, url, time.monotonic() - start, retries=attempt)
+                raise errors.StoreNetworkError(asyncio.TimeoutError("deadline reached"))
+            try:
+                async with session.request(
+                    method,
+                    url,
+                    headers=headers,
+                    params=params,
+                    timeout=aiohttp.ClientTimeout(total=remaining),
+                    **kwargs
+                ) as raw_response:
+                    response = Response(raw_response, await raw_response.read())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            else:
+                if (
+                    response.status_code not in STATUS_FORCELIST
+                    or not idempotent
+                    or attempt >= self._retries
+                ):
+                    break
+            delay = self._backoff_time(attempt, response)
+            if error is not None and (
+                attempt >= self._retries
+                or time.monotonic() + delay >= deadline
+                or not (idempotent or isinstance(error, aiohttp.ClientConnectorError))
+            ):
+                self.metrics.record(
+                    method, url, time.monotonic() - start, retries=attempt
+                )
+                raise errors.StoreNetworkError(error) from error
+            if time.monotonic() + delay >= deadline:
+                # No time for another attempt, return the last response.
+                break
+            await asyncio.sleep(delay)
+            attempt += 1
+
+        self.metrics.record(
+            method,
+            url,
+            time.monotonic() - start,
+            status=response.status_code,
+            retries=attempt,
+        )
+
+        # Handle 5XX responses generically right here, so the callers don't
+        # need to worry about it.
+        if response.status_code >= 500:
+            raise errors.StoreServerError(response)
+
+        return response
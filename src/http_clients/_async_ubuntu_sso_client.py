@@ -0,0 +1,199 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2021 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import Optional
+from urllib.parse import urljoin
+
+import requests
+from simplejson.scanner import JSONDecodeError
+
+from . import errors, _async_http_client
+from ._ubuntu_sso_client import (
+    UBUNTU_ONE_SSO_URL,
+    UbuntuOneAuthClient,
+    UbuntuOneSSOConfig,
+    _extract_caveat_id,
+    _macaroon_auth,
+    _refresh_time,
+)
+
+
+class AsyncUbuntuOneAuthClient(_async_http_client.AsyncClient):
+    """Asyncio Store Client using Ubuntu One SSO provided macaroons.
+
+    A discharge with an expiry caveat is refreshed before the first request
+    made within STORE_REFRESH_MARGIN seconds of its expiry.
+    """
+
+    _is_needs_refresh_response = staticmethod(
+        UbuntuOneAuthClient._is_needs_refresh_response
+    )
+
+    def __init__(
+        self, *, user_agent: str = "make-system-user", pool_size: Optional[int] = None
+    ) -> None:
+        super().__init__(user_agent=user_agent, pool_size=pool_size)
+
+        self._conf = UbuntuOneSSOConfig()
+        self.auth_url = os.environ.get("UBUNTU_ONE_SSO_URL", UBUNTU_ONE_SSO_URL)
+        # Only one refresh at a time; the requests that were rejected
+        # meanwhile use the discharge it got. The lock is created on first
+        # use so it binds to the running loop.
+        self._refresh_lock: Optional[asyncio.Lock] = None
+        self._auth_generation = 0
+        self._refresh_margin = float(os.environ.get("STORE_REFRESH_MARGIN", 60))
+        self._refresh_at: Optional[float] = None
+
+        try:
+            self._set_auth()
+        except:
+            print("Error: please complete 'snapcraft login' and try again.")
+            sys.exit(1)
+
+    def _set_auth(self) -> None:
+        self.auth: Optional[str] = _macaroon_auth(self._conf)
+        self._refresh_at = _refresh_time(
+            self._conf.get("unbound_discharge"), self._refresh_margin
+        )
+
+    async def _refresh_token(self, unbound_discharge):
+        data = {"discharge_macaroon": unbound_discharge}
+        url = urljoin(self.auth_url, "/api/v2/tokens/refresh")
+        response = await self.request(
+            "POST",
+            url,
+            json=data,
+            headers={"Content-Type": "application/json", "Accept": "application/json"},
+            auth_header=False,
+        )
+        if response.ok:
+            return response.json()["discharge_macaroon"]
+        else:
+            raise errors.StoreAuthenticationError(
+                "Failed to refresh unbound discharge", response
+            )
+
+    async def _refresh(self, rejected_generation: int) -> None:
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+        async with self._refresh_lock:
+            if self._auth_generation != rejected_generation:
+                # Another request refreshed while we waited.
+                return
+            stale_discharge = self._conf.get("unbound_discharge")
+            # Share the refresh with other processes, see UbuntuOneAuthClient.
+            async with self._conf.lock_async():
+                self._conf.load()
+                if self._conf.get("unbound_discharge") == stale_discharge:
+                    unbound_discharge = await self._refresh_token(stale_discharge)
+                    with self._conf.batch():
+                        self._conf.set("unbound_discharge", unbound_discharge)
+                        self._conf.save()
+            self._set_auth()
+            self._auth_generation += 1
+
+    async def _discharge_token(
+        self, email: str, password: str, otp: Optional[str], caveat_id
+    ) -> str:
+        data = dict(email=email, password=password, caveat_id=caveat_id)
+        if otp:
+            data["otp"] = otp
+
+        url = urljoin(self.auth_url, "/api/v2/tokens/discharge")
+
+        response = await self.request(
+            "POST",
+            url,
+            data=json.dumps(data),
+            headers={"Content-Type": "application/json", "Accept": "application/json"},
+            auth_header=False,
+        )
+
+        if response.ok:
+            return response.json()["discharge_macaroon"]
+
+        try:
+            response_json = response.json()
+        except JSONDecodeError:
+            response_json = dict()
+
+        if response.status_code == requests.codes.unauthorized and any(
+            error.get("code") == "twofactor-required"
+            for error in response_json.get("error_list", [])
+        ):
+            raise errors.StoreTwoFactorAuthenticationRequired()
+        else:
+            raise errors.StoreAuthenticationError(
+                "Failed to get unbound discharge", response
+            )
+
+    async def login(
+        self,
+        email: str,
+        password: str,
+        macaroon: str,
+        otp: Optional[str] = None,
+        save: bool = True,
+    ) -> None:
+        caveat_id = _extract_caveat_id(macaroon, self.auth_url)
+        unbound_discharge = await self._discharge_token(
+            email, password, otp, caveat_id
+        )
+        with self._conf.batch():
+            # Clear any old data before setting.
+            self._conf.clear()
+            # The macaroon has been discharged, save it in the config
+            self._conf.set("macaroon", macaroon)
+            self._conf.set("unbound_discharge", unbound_discharge)
+            self._conf.set("email", email)
+
+            # Set auth and headers.
+            self._set_auth()
+            self._auth_generation += 1
+
+            if save:
+                self._conf.save()
+
+    async def request(
+        self, method, url, params=None, headers=None, auth_header=True, **kwargs
+    ) -> _async_http_client.Response:
+        headers = dict(headers) if headers else {}
+        generation = self._auth_generation
+        if auth_header:
+            if self._refresh_at is not None and time.time() >= self._refresh_at:
+                # Expired or about to: refresh first rather than be rejected.
+                await self._refresh(generation)
+                generation = self._auth_generation
+            headers["Authorization"] = self.auth
+
+        response = await super().request(
+            method, url, params=params, headers=headers, **kwargs
+        )
+
+        if auth_header and self._is_needs_refresh_response(response):
+            await self._refresh(generation)
+            headers["Authorization"] = self.auth
+
+            response = await super().request(
+                method, url, params=params, headers=headers, **kwargs
+            )
+
+        return response
@@ -16,10 +16,14 @@
 
 import abc
 import base64
+import contextlib
+import fcntl
 import io
 import os
 import pathlib
-from typing import Optional, TextIO
+import tempfile
+import threading
+from typing import AsyncIterator, Iterator, Optional, TextIO, Tuple
 
 import configparser
 
@@ -27,8 +31,22 @@ from . import errors
 
 
 class Config(abc.ABC):
+    """Options in sections of an ini file.
+
+    save() replaces the file atomically with a renamed temporary file while
+    holding an advisory lock on a sibling ".lock" file, so processes saving
+    at the same time never leave a torn file. The save() calls made inside
+    batch() are deferred to a single write when the outermost batch ends.
+    load() does not read the file again while it is unchanged since it was
+    last read or written.
+    """
+
     def __init__(self) -> None:
         self.parser = configparser.ConfigParser()
+        # Lock and batch depths are per thread, so one thread holding the
+        # lock does not let another one write without it.
+        self._local = threading.local()
+        self._file_stamp: Optional[Tuple[int, int, int]] = None
         self.load()
 
     @abc.abstractmethod
@@ -86,18 +104,110 @@ class Config(abc.ABC):
             except configparser.Error as parser_error:
                 raise errors.InvalidLoginConfig(parser_error)
 
+    def _stamp(self, path: pathlib.Path) -> Optional[Tuple[int, int, int]]:
+        """Return what identifies the current content of path, None if missing."""
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
     def load(self, *, config_fd: TextIO = None) -> None:
         if config_fd is not None:
-            config_content = config_fd.read()
-        elif self._get_config_path().exists():
-            with self._get_config_path().open() as config_file:
-                config_content = config_file.read()
-        else:
+            self._load_potentially_base64_config(config_fd.read())
             return
 
+        config_path = self._get_config_path()
+        stamp = self._stamp(config_path)
+        if stamp is None or stamp == self._file_stamp:
+            return
+        with config_path.open() as config_file:
+            config_content = config_file.read()
+        if self._file_stamp is not None:
+            # Changed by another process, drop what was read before.
+            self.parser = configparser.ConfigParser()
         self._load_potentially_base64_config(config_content)
+        self._file_stamp = stamp
+
+    def _lock_fd(self, blocking: bool) -> Optional[int]:
+        """Return a descriptor holding the file lock, None if not blocking and busy."""
+        config_path = self._get_config_path()
+        lock_path = config_path.with_name(config_path.name + ".lock")
+        fd = os.open(str(lock_path), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    @contextlib.contextmanager
+    def _held(self, fd: Optional[int]) -> Iterator[None]:
+        if fd is None:
+            # Taken again by the thread holding it.
+            self._local.lock_depth += 1
+            try:
+                yield
+            finally:
+                self._local.lock_depth -= 1
+            return
+        self._local.lock_depth = 1
+        try:
+            yield
+        finally:
+            self._local.lock_depth = 0
+            os.close(fd)
+
+    def _lock_held(self) -> bool:
+        return getattr(self._local, "lock_depth", 0) > 0
+
+    @contextlib.contextmanager
+    def lock(self) -> Iterator[None]:
+        """Hold the advisory lock that serializes writers of the file.
+
+        The thread holding the lock may take it again, so a read-modify-write
+        of the file can hold it across load() and save().
+        """
+        fd = None if self._lock_held() else self._lock_fd(blocking=True)
+        with self._held(fd):
+            yield
+
+    @contextlib.asynccontextmanager
+    async def lock_async(self, poll: float = 0.05) -> AsyncIterator[None]:
+        """lock() for event loops, waiting for the file lock without blocking the loop."""
+        import asyncio
+
+        fd = None
+        if not self._lock_held():
+            fd = self._lock_fd(blocking=False)
+            while fd is None:
+                await asyncio.sleep(poll)
+                fd = self._lock_fd(blocking=False)
+        with self._held(fd):
+            yield
+
+    @contextlib.contextmanager
+    def batch(self) -> Iterator[None]:
+        """Defer the saves made inside to one write at the end."""
+        depth = getattr(self._local, "batch_depth", 0)
+        if depth == 0:
+            self._local.save_pending = False
+        self._local.batch_depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.batch_depth = depth
+        if depth == 0 and self._local.save_pending:
+            self.save()
 
     def save(self, *, config_fd: Optional[TextIO] = None, encode: bool = False) -> None:
+        if config_fd is None and getattr(self._local, "batch_depth", 0):
+            self._local.save_pending = True
+            return
+
         with io.StringIO() as config_buffer:
             self.parser.write(config_buffer)
             config_content = config_buffer.getvalue()
@@ -107,10 +217,25 @@ class Config(abc.ABC):
             if config_fd:
                 print(config_content, file=config_fd)
             else:
-                with self._get_config_path().open("w") as config_file:
-                    print(config_content, file=config_file)
-                    config_file.flush()
-                    os.fsync(config_file.fileno())
+                with self.lock():
+                    self._write(config_content)
+
+    def _write(self, config_content: str) -> None:
+        config_path = self._get_config_path()
+        fd, temp_path = tempfile.mkstemp(
+            dir=str(config_path.parent), prefix=config_path.name + "."
+        )
+        try:
+            with os.fdopen(fd, "w") as config_file:
+                print(config_content, file=config_file)
+                config_file.flush()
+                os.fsync(config_file.fileno())
+            os.replace(temp_path, str(config_path))
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(temp_path)
+            raise
+        self._file_stamp = self._stamp(config_path)
 
     def clear(self, section_name: Optional[str] = None) -> None:
         if section_name is None:
@@ -16,13 +16,20 @@
 
 import os
 import logging
+import random
+import threading
+import time
 
 import requests
 from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError, RetryError
+from requests.packages.urllib3.exceptions import MaxRetryError, ResponseError
 from requests.packages.urllib3.util.retry import Retry
+from requests.packages.urllib3.util.timeout import Timeout
 
 from . import errors
+from . import _tracing
+from ._metrics import RequestMetrics
 
 
 # Set urllib3's logger to only emit errors, not warnings. Otherwise even
@@ -30,6 +37,109 @@ from . import errors
 logging.getLogger(requests.packages.urllib3.__package__).setLevel(logging.ERROR)
 logger = logging.getLogger(__name__)
 
+# Response codes that are retried by the clients. For 429 and 503 the
+# Retry-After header is honoured.
+STATUS_FORCELIST = [429, 500, 502, 503, 504]
+# The methods urllib3 retries by default, so DeadlineRetry retries them
+# too: POST and PATCH are not idempotent, retrying one could repeat its
+# side effect on the server.
+IDEMPOTENT_METHODS = frozenset(["DELETE", "GET", "HEAD", "OPTIONS", "PUT", "TRACE"])
+
+# The deadline of the request running in each thread, see DeadlineRetry.
+_operation = threading.local()
+
+
+class DeadlineRetry(Retry):
+    """Retry with jittered backoff that gives up once the operation deadline passes.
+
+    Client.request() sets the deadline of the operation for the current
+    thread. A retry whose backoff would reach the deadline is not made, so
+    the operation ends with the last response or error instead.
+    """
+
+    def __init__(self, *args, jitter: float = 0.5, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.jitter = jitter
+
+    def new(self, **kw):
+        kw.setdefault("jitter", self.jitter)
+        return super().new(**kw)
+
+    @staticmethod
+    def remaining():
+        deadline = getattr(_operation, "deadline", None)
+        if deadline is None:
+            return None
+        return deadline - time.monotonic()
+
+    def get_backoff_time(self) -> float:
+        backoff = super().get_backoff_time()
+        # Spread the retries of parallel clients so they do not hit the
+        # store in lockstep.
+        return backoff * (1 - self.jitter * random.random())
+
+    def is_exhausted(self) -> bool:
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            return True
+        return super().is_exhausted()
+
+    def _delay(self, response=None) -> float:
+        delay = None
+        if response is not None and self.respect_retry_after_header:
+            delay = self.get_retry_after(response)
+        if delay is None:
+            delay = self.get_backoff_time()
+        return delay
+
+    def increment(
+        self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None
+    ):
+        new_retry = super().increment(
+            method=method,
+            url=url,
+            response=response,
+            error=error,
+            _pool=_pool,
+            _stacktrace=_stacktrace,
+        )
+        remaining = self.remaining()
+        if remaining is not None:
+            # Decide the backoff now, so the retry is given up while there is
+            # still a response or error to return.
+            delay = new_retry._delay(response)
+            if delay >= remaining:
+                reason = error or ResponseError("deadline reached")
+                raise MaxRetryError(_pool, url, reason) from reason
+            new_retry._planned_delay = delay
+        return new_retry
+
+    def sleep(self, response=None) -> None:
+        delay = getattr(self, "_planned_delay", None)
+        if delay is None:
+            delay = self._delay(response)
+        if delay > 0:
+            with _tracing.span("http retry backoff", delay=delay):
+                time.sleep(delay)
+
+
+class _DeadlineTimeout(Timeout):
+    """A timeout that gives every attempt what is left of the deadline.
+
+    urllib3 clones the timeout for each attempt, retries included.
+    """
+
+    def __init__(self, deadline: float) -> None:
+        self._deadline = deadline
+        super().__init__(total=self._remaining())
+
+    def _remaining(self) -> float:
+        # urllib3 refuses a timeout of 0, and None would mean no timeout.
+        return max(self._deadline - time.monotonic(), 0.001)
+
+    def clone(self):
+        return Timeout(total=self._remaining())
+
 
 class Client:
     """Generic Client to talk to the *Store."""
@@ -37,12 +147,17 @@ class Client:
     def __init__(self, *, user_agent: str = "make-system-user" )-> None:
         self.session = requests.Session()
         self._user_agent = user_agent
+        # Overall time budget of one request, retries included.
+        self.deadline = float(os.environ.get("STORE_DEADLINE", 60))
+        self.metrics = RequestMetrics()
 
         # Setup max retries for all store URLs and the CDN
-        retries = Retry(
+        retries = DeadlineRetry(
             total=int(os.environ.get("STORE_RETRIES", 5)),
             backoff_factor=int(os.environ.get("STORE_BACKOFF", 2)),
-            status_forcelist=[104, 500, 502, 503, 504],
+            status_forcelist=STATUS_FORCELIST,
+            jitter=float(os.environ.get("STORE_JITTER", 0.5)),
+            raise_on_status=False,
         )
         self.session.mount("http://", HTTPAdapter(max_retries=retries))
         self.session.mount("https://", HTTPAdapter(max_retries=retries))
@@ -74,12 +189,29 @@ class Client:
                 url, params, debug_headers
             )
         )
+        start = time.monotonic()
+        _operation.deadline = start + self.deadline
+        # No attempt may outlast what is left of the budget.
+        kwargs.setdefault("timeout", _DeadlineTimeout(_operation.deadline))
         try:
-            response = self.session.request(
-                method, url, headers=headers, params=params, **kwargs
-            )
+            with _tracing.span("http " + RequestMetrics.endpoint(method, url)):
+                response = self.session.request(
+                    method, url, headers=headers, params=params, **kwargs
+                )
         except (ConnectionError, RetryError) as e:
+            self.metrics.record(method, url, time.monotonic() - start)
             raise errors.StoreNetworkError(e) from e
+        finally:
+            _operation.deadline = None
+
+        history = getattr(getattr(response.raw, "retries", None), "history", ())
+        self.metrics.record(
+            method,
+            url,
+            time.monotonic() - start,
+            status=response.status_code,
+            retries=len(history),
+        )
 
         # Handle 5XX responses generically right here, so the callers don't
         # need to worry about it.
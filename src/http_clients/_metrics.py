@@ -0,0 +1,101 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2021 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import math
+import threading
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+# Number of latencies kept per endpoint for the percentiles.
+LATENCY_WINDOW = 1000
+
+
+def percentile(values, p):
+    """Return the p-th percentile of sorted values, by nearest rank."""
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, math.ceil(p / 100.0 * len(values)) - 1))
+    return values[rank]
+
+
+class _EndpointMetrics:
+    def __init__(self) -> None:
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_time = 0.0
+        self.statuses: Dict[str, int] = collections.Counter()
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+
+class RequestMetrics:
+    """Counts, latencies and retry attempts of requests, per endpoint.
+
+    An endpoint is the method and the URL without its query, for example
+    "GET https://dashboard.snapcraft.io/dev/api/account".
+    """
+
+    def __init__(self) -> None:
+        self._endpoints: Dict[str, _EndpointMetrics] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def endpoint(method: str, url: str) -> str:
+        parsed = urlparse(url)
+        return "{} {}://{}{}".format(
+            method.upper(), parsed.scheme, parsed.netloc, parsed.path
+        )
+
+    def record(
+        self,
+        method: str,
+        url: str,
+        seconds: float,
+        status: Optional[int] = None,
+        retries: int = 0,
+    ) -> None:
+        """Record one request; a status of None means it failed without a response."""
+        key = self.endpoint(method, url)
+        with self._lock:
+            metrics = self._endpoints.get(key)
+            if metrics is None:
+                metrics = self._endpoints[key] = _EndpointMetrics()
+            metrics.requests += 1
+            metrics.retries += retries
+            metrics.total_time += seconds
+            metrics.latencies.append(seconds)
+            metrics.statuses[str(status) if status is not None else "error"] += 1
+            if status is None or status >= 400:
+                metrics.errors += 1
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Return the metrics of every endpoint as plain dicts."""
+        with self._lock:
+            result = {}
+            for key, metrics in self._endpoints.items():
+                latencies = sorted(metrics.latencies)
+                result[key] = {
+                    "requests": metrics.requests,
+                    "errors": metrics.errors,
+                    "retries": metrics.retries,
+                    "statuses": dict(metrics.statuses),
+                    "total_time": metrics.total_time,
+                    "p50": percentile(latencies, 50),
+                    "p95": percentile(latencies, 95),
+                    "p99": percentile(latencies, 99),
+                }
+            return result
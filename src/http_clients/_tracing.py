@@ -0,0 +1,32 @@
+# -*- Mode:Python; indent-tabs-mode:nil; tab-width:4 -*-
+#
+# Copyright 2021 Canonical Ltd
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import contextlib
+
+# An object with a span(name, **args) context manager method, or None.
+_tracer = None
+
+
+def set_tracer(tracer) -> None:
+    """Report the timing of requests and retries to tracer.span()."""
+    global _tracer
+    _tracer = tracer
+
+
+def span(name: str, **args):
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.span(name, **args)
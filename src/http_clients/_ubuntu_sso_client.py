@@ -14,11 +14,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import functools
 import logging
 import json
 import os
 import pathlib
 import sys
+import threading
+import time
+from datetime import datetime, timezone
 from typing import Optional, Iterable, Dict, TextIO
 from urllib.parse import urljoin, urlparse
 
@@ -57,6 +61,13 @@ def _macaroon_auth(conf):
     if unbound_raw is None:
         raise errors.InvalidCredentialsError("Unbound discharge not in the config file")
 
+    return _bound_macaroon_auth(root_macaroon_raw, unbound_raw)
+
+
+# Binding the discharge costs two deserializations and an HMAC; the result
+# only changes with the credentials, so keep it for the raw macaroons.
+@functools.lru_cache(maxsize=16)
+def _bound_macaroon_auth(root_macaroon_raw: str, unbound_raw: str) -> str:
     root_macaroon = _deserialize_macaroon(root_macaroon_raw)
     unbound = _deserialize_macaroon(unbound_raw)
     bound = root_macaroon.prepare_for_request(unbound)
@@ -68,6 +79,56 @@ def _macaroon_auth(conf):
     return auth
 
 
+@functools.lru_cache(maxsize=16)
+def _discharge_expiry(unbound_raw: Optional[str]) -> Optional[float]:
+    """Return when a discharge expires, from its "HOST|expires|TIME" caveat.
+
+    :return: A POSIX timestamp, or None if the discharge has no such caveat.
+    """
+    if unbound_raw is None:
+        return None
+    try:
+        discharge = pymacaroons.Macaroon.deserialize(unbound_raw)
+    except:  # noqa LP: #1733004
+        return None
+    for caveat in discharge.caveats:
+        parts = caveat.caveat_id.split("|")
+        if len(parts) != 3 or parts[1] != "expires":
+            continue
+        for time_format in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+            try:
+                expires = datetime.strptime(parts[2], time_format)
+            except ValueError:
+                continue
+            return expires.replace(tzinfo=timezone.utc).timestamp()
+    return None
+
+
+def _extract_caveat_id(root_macaroon: str, auth_url: str) -> str:
+    """Return the id of the root macaroon's caveat for the SSO at auth_url."""
+    macaroon = pymacaroons.Macaroon.deserialize(root_macaroon)
+    # macaroons are all bytes, never strings
+    sso_host = urlparse(auth_url).netloc
+    for caveat in macaroon.caveats:
+        if caveat.location == sso_host:
+            return caveat.caveat_id
+    else:
+        raise errors.InvalidCredentialsError("Invalid root macaroon")
+
+
+def _refresh_time(unbound_raw: Optional[str], margin: float) -> Optional[float]:
+    """Return when to refresh a discharge: margin seconds before it expires.
+
+    A discharge with less than twice margin left is refreshed halfway, so a
+    short-lived one is not refreshed before every request.
+    """
+    expires = _discharge_expiry(unbound_raw)
+    if expires is None:
+        return None
+    remaining = expires - time.time()
+    return expires - min(margin, max(remaining, 0) / 2)
+
+
 class UbuntuOneSSOConfig(_config.Config):
     """Hold configuration options in sections.
 
@@ -88,7 +149,16 @@ class UbuntuOneSSOConfig(_config.Config):
 
 
 class UbuntuOneAuthClient(_http_client.Client):
-    """Store Client using Ubuntu One SSO provided macaroons."""
+    """Store Client using Ubuntu One SSO provided macaroons.
+
+    When the discharge carries an expiry caveat it is refreshed by a
+    background timer STORE_REFRESH_MARGIN seconds (default 60) before it
+    expires, so requests are not rejected with needs_refresh first.
+
+    A refresh holds the lock of snapcraft.cfg and first reloads it, so of
+    the clients and processes that need a refresh at the same time only
+    the first asks SSO and the others use the discharge it saved.
+    """
 
     @staticmethod
     def _is_needs_refresh_response(response):
@@ -102,21 +172,74 @@ class UbuntuOneAuthClient(_http_client.Client):
 
         self._conf = UbuntuOneSSOConfig()
         self.auth_url = os.environ.get("UBUNTU_ONE_SSO_URL", UBUNTU_ONE_SSO_URL)
+        # Only one refresh at a time; the requests that were rejected
+        # meanwhile use the discharge it got.
+        self._refresh_lock = threading.Lock()
+        self._auth_generation = 0
+        self._refresh_margin = float(os.environ.get("STORE_REFRESH_MARGIN", 60))
+        self._refresh_timer: Optional[threading.Timer] = None
+        self._refresh_at: Optional[float] = None
 
         try:
-            self.auth: Optional[str] = _macaroon_auth(self._conf)
+            self._set_auth()
         except: 
             print("Error: please complete 'snapcraft login' and try again.")
             sys.exit(1)
-    def _extract_caveat_id(self, root_macaroon):
-        macaroon = pymacaroons.Macaroon.deserialize(root_macaroon)
-        # macaroons are all bytes, never strings
-        sso_host = urlparse(self.auth_url).netloc
-        for caveat in macaroon.caveats:
-            if caveat.location == sso_host:
-                return caveat.caveat_id
-        else:
-            raise errors.InvalidCredentialsError("Invalid root macaroon")
+
+    def _set_auth(self) -> None:
+        self.auth: Optional[str] = _macaroon_auth(self._conf)
+        self._auth_generation += 1
+        self._refresh_at = _refresh_time(
+            self._conf.get("unbound_discharge"), self._refresh_margin
+        )
+        self._schedule_refresh()
+
+    def _schedule_refresh(self) -> None:
+        if self._refresh_timer is not None:
+            self._refresh_timer.cancel()
+            self._refresh_timer = None
+        if self._refresh_at is None:
+            return
+        delay = self._refresh_at - time.time()
+        if delay <= 0:
+            # Already due, request() refreshes before its next request.
+            return
+        self._refresh_timer = threading.Timer(delay, self._background_refresh)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _refresh_due(self) -> bool:
+        return self._refresh_at is not None and time.time() >= self._refresh_at
+
+    def _background_refresh(self) -> None:
+        try:
+            self._refresh(self._auth_generation)
+        except Exception as e:
+            # The next request refreshes after its needs_refresh response.
+            logger.debug("Background refresh of the discharge failed: {}".format(e))
+
+    def _refresh(self, rejected_generation: int) -> None:
+        with self._refresh_lock:
+            if self._auth_generation != rejected_generation:
+                # Another request refreshed while we waited.
+                return
+            stale_discharge = self._conf.get("unbound_discharge")
+            # Other processes and clients refresh under the same file lock.
+            with self._conf.lock():
+                self._conf.load()
+                if self._conf.get("unbound_discharge") == stale_discharge:
+                    unbound_discharge = self._refresh_token(stale_discharge)
+                    with self._conf.batch():
+                        self._conf.set("unbound_discharge", unbound_discharge)
+                        self._conf.save()
+            self._set_auth()
+
+    def close(self) -> None:
+        """Stop the background refresh and close the connections."""
+        if self._refresh_timer is not None:
+            self._refresh_timer.cancel()
+            self._refresh_timer = None
+        self.session.close()
 
     def login(
         self,
@@ -127,35 +250,39 @@ class UbuntuOneAuthClient(_http_client.Client):
         config_fd: TextIO = None,
         save: bool = True,
     ) -> None:
-        if config_fd is not None:
-            self._conf.load(config_fd=config_fd)
-        # Verbose to keep static checks happy.
-        elif email is not None and password is not None and macaroon is not None:
+        if config_fd is None and email is not None and password is not None and macaroon is not None:
             # Ask the store for the needed capabilities to be associated with
             # the macaroon.
-            caveat_id = self._extract_caveat_id(macaroon)
+            caveat_id = _extract_caveat_id(macaroon, self.auth_url)
             unbound_discharge = self._discharge_token(email, password, otp, caveat_id)
-            # Clear any old data before setting.
-            self._conf.clear()
-            # The macaroon has been discharged, save it in the config
-            self._conf.set("macaroon", macaroon)
-            self._conf.set("unbound_discharge", unbound_discharge)
-            self._conf.set("email", email)
-        else:
-            print("Logic Error in login")
 
-        # Set auth and headers.
-        self.auth = _macaroon_auth(self._conf)
-
-        if save:
-            self._conf.save()
+        with self._conf.batch():
+            if config_fd is not None:
+                self._conf.load(config_fd=config_fd)
+            # Verbose to keep static checks happy.
+            elif email is not None and password is not None and macaroon is not None:
+                # Clear any old data before setting.
+                self._conf.clear()
+                # The macaroon has been discharged, save it in the config
+                self._conf.set("macaroon", macaroon)
+                self._conf.set("unbound_discharge", unbound_discharge)
+                self._conf.set("email", email)
+            else:
+                print("Logic Error in login")
+
+            # Set auth and headers.
+            self._set_auth()
+
+            if save:
+                self._conf.save()
 
     def export_login(self, *, config_fd: TextIO, encode: bool = False) -> None:
         self._conf.save(config_fd=config_fd, encode=encode)
 
     def logout(self) -> None:
-        self._conf.clear()
-        self._conf.save()
+        with self._conf.batch():
+            self._conf.clear()
+            self._conf.save()
 
     def get_macaroon(
         self,
@@ -198,6 +325,7 @@ class UbuntuOneAuthClient(_http_client.Client):
             url,
             data=json.dumps(data),
             headers={"Content-Type": "application/json", "Accept": "application/json"},
+            auth_header=False,
         )
 
         if response.ok:
@@ -226,6 +354,7 @@ class UbuntuOneAuthClient(_http_client.Client):
             url,
             json=data,
             headers={"Content-Type": "application/json", "Accept": "application/json"},
+            auth_header=False,
         )
         if response.ok:
             return response.json()["discharge_macaroon"]
@@ -237,6 +366,12 @@ class UbuntuOneAuthClient(_http_client.Client):
     def request(
         self, method, url, params=None, headers=None, auth_header=True, **kwargs
     ) -> requests.Response:
+        generation = self._auth_generation
+        if auth_header and self._refresh_due():
+            # Expired or about to: refresh first rather than be rejected.
+            self._refresh(generation)
+            generation = self._auth_generation
+
         if headers and auth_header:
             headers["Authorization"] = self.auth
         elif auth_header:
@@ -246,11 +381,8 @@ class UbuntuOneAuthClient(_http_client.Client):
             method, url, params=params, headers=headers, **kwargs
         )
 
-        if self._is_needs_refresh_response(response):
-            unbound_discharge = self._refresh_token(self._conf.get("unbound_discharge"))
-            self._conf.set("unbound_discharge", unbound_discharge)
-            self._conf.save()
-            self.auth = _macaroon_auth(self._conf)
+        if auth_header and self._is_needs_refresh_response(response):
+            self._refresh(generation)
             headers["Authorization"] = self.auth
 
             response = super().request(
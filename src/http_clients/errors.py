@@ -42,8 +42,7 @@ class SnapcraftError(Exception):
 
 
 # TODO: migrate to storeapi private exception to ready craft-store.
-#class HttpClientError(SnapcraftError):
-class HttpClientError():
+class HttpClientError(SnapcraftError):
     """Base class http client errors.
 
     :cvar fmt: A format string that daughter classes override
@@ -0,0 +1,66 @@
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Writing --output-bundle files and reading them back with msu_bundle.
+
+    python3 -m pytest -q tests
+"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'launchers', 'bin'))
+
+import msu_bundle  # noqa: E402
+
+
+def _user(row, serials):
+    return {'row': row, 'username': 'user{}'.format(row), 'serials': serials}
+
+
+@pytest.fixture
+def bundlePath(tmp_path):
+    path = str(tmp_path / 'devices.bundle')
+    with msu_bundle.BundleWriter(path) as writer:
+        writer.write(_user(1, ['serial-1', 'serial-2']), ('account', 'account-key', 'user one'))
+        writer.write(_user(2, None), ('account', 'account-key', 'user two'))
+    return path
+
+
+def test_get(bundlePath):
+    with msu_bundle.Bundle(bundlePath) as bundle:
+        assert bundle.get('serial-1') == b'account\naccount-key\nuser one'
+        assert bundle.get('serial-2') == b'account\naccount-key\nuser one'
+        assert bundle.get('user2') == b'account\naccount-key\nuser two'
+        assert bundle.get('serial-3') is None
+
+
+def test_truncated(bundlePath):
+    size = os.path.getsize(bundlePath)
+    for length in (size - 1, size // 2, msu_bundle._HEADER.size):
+        with open(bundlePath, 'r+b') as f:
+            f.truncate(length)
+        with pytest.raises(msu_bundle.BundleError):
+            msu_bundle.Bundle(bundlePath)
+
+
+def test_main_reports_truncated(bundlePath, capsys):
+    with open(bundlePath, 'r+b') as f:
+        f.truncate(os.path.getsize(bundlePath) - 1)
+    assert msu_bundle.main([bundlePath, 'serial-1', '-o', '-']) == 1
+    assert 'truncated' in capsys.readouterr().out
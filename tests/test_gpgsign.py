@@ -0,0 +1,165 @@
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+The gpg-agent signer against gpg and "snap sign", with a throwaway key.
+
+The assertion text is compared with the text snapd writes for the same
+headers. The signature is checked with gpg --verify whenever gpg is
+installed, and the output is compared with "snap sign" when snap is
+installed too.
+
+    python3 -m pytest -q tests
+"""
+
+import base64
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'launchers', 'bin'))
+
+import msu_gpgsign  # noqa: E402
+import msu_sign  # noqa: E402
+
+KEY_NAME = 'msu-test-key'
+
+needsGpg = pytest.mark.skipif(
+    not all(shutil.which(cmd) for cmd in ('gpg', 'gpgconf', 'gpg-agent')),
+    reason='needs gpg and gpg-agent')
+
+
+def _gpg(home, *args, **kwargs):
+    return subprocess.run(['gpg', '--homedir', home, '--batch', '--no-tty'] + list(args),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+
+
+@pytest.fixture(scope='module')
+def gnupgHome():
+    # short, as the agent socket may be made inside it
+    home = tempfile.mkdtemp(prefix='msu-gpg-', dir='/tmp')
+    try:
+        res = _gpg(home, '--passphrase', '', '--quick-gen-key', KEY_NAME, 'rsa2048', 'sign', 'never')
+        assert res.returncode == 0, res.stderr
+        yield home
+    finally:
+        subprocess.run(['gpgconf', '--homedir', home, '--kill', 'gpg-agent'])
+        shutil.rmtree(home, ignore_errors=True)
+
+
+def _assertion():
+    return {
+        'type': 'system-user',
+        'authority-id': 'testaccount',
+        'brand-id': 'testaccount',
+        'email': 'someone@example.com',
+        'series': ['16'],
+        'models': ['testmodel'],
+        'name': 'Default User',
+        'username': 'someone',
+        'ssh-keys': ['ssh-ed25519 AAAAC3NzaC1lZDI1NTE5 someone@host'],
+        'since': '2021-01-01T00:00:00+00:00',
+        'until': '2022-01-01T00:00:00+00:00',
+    }
+
+
+def _checkAgainstSnapSign(signer, assertJson):
+    """Sign assertJson with both signers and compare everything but the signature.
+
+    The signatures themselves differ because they carry their creation time.
+    """
+    ours = signer(assertJson)
+    theirs = msu_sign.signAssertion(assertJson, signer.keyName)
+    assert ours.rsplit('\n\n', 1)[0] == theirs.rsplit('\n\n', 1)[0]
+
+
+def _serialsAssertion():
+    assertion = _assertion()
+    assertion['format'] = '1'
+    assertion['revision'] = '1'
+    assertion['serials'] = ['serial-1', 'serial-2']
+    return assertion
+
+
+# as snapd's assembleAndSign writes _serialsAssertion(): format right after
+# type, then authority-id, revision, the primary keys and the rest sorted
+SERIALS_CONTENT = """type: system-user
+format: 1
+authority-id: testaccount
+revision: 1
+brand-id: testaccount
+email: someone@example.com
+models:
+  - testmodel
+name: Default User
+serials:
+  - serial-1
+  - serial-2
+series:
+  - 16
+since: 2021-01-01T00:00:00+00:00
+ssh-keys:
+  - ssh-ed25519 AAAAC3NzaC1lZDI1NTE5 someone@host
+until: 2022-01-01T00:00:00+00:00
+username: someone
+sign-key-sha3-384: testkeyid"""
+
+
+def test_content_matches_snapd_with_serials():
+    content = msu_gpgsign.assembleContent(_serialsAssertion(), 'testkeyid')
+    assert content.decode('utf-8') == SERIALS_CONTENT
+
+
+def test_content_drops_default_format_and_empty_values():
+    assertion = _assertion()
+    assertion['format'] = '0'
+    assertion['serials'] = []
+    assertion['models'] = []
+    content = msu_gpgsign.assembleContent(assertion, 'testkeyid').decode('utf-8')
+    assert content.startswith('type: system-user\nauthority-id: testaccount\n')
+    assert 'format' not in content
+    assert 'serials' not in content
+    assert 'models' not in content
+
+
+@needsGpg
+def test_signature_verifies(gnupgHome, tmp_path):
+    signer = msu_gpgsign.AgentSigner(KEY_NAME, 'testkeyid', gnupgHome=gnupgHome)
+    signed = signer(_assertion())
+    content, signature = signed.rsplit('\n\n', 1)
+    assert content.startswith('type: system-user\nauthority-id: testaccount\nbrand-id: testaccount\nemail: someone@example.com\n')
+    assert content.endswith('\nsign-key-sha3-384: testkeyid')
+    packet = base64.b64decode(signature)
+    assert packet[:1] == b'\x01'
+    (tmp_path / 'content').write_bytes(content.encode('utf-8'))
+    (tmp_path / 'content.sig').write_bytes(packet[1:])
+    res = _gpg(gnupgHome, '--verify', str(tmp_path / 'content.sig'), str(tmp_path / 'content'))
+    assert res.returncode == 0, res.stderr
+
+
+@needsGpg
+@pytest.mark.skipif(shutil.which('snap') is None, reason='needs snap')
+def test_matches_snap_sign(gnupgHome, monkeypatch):
+    monkeypatch.setenv('SNAP_GNUPG_HOME', gnupgHome)
+    res = subprocess.run(['snap', 'keys', '--json'], stdout=subprocess.PIPE, check=True)
+    keys = {key['name']: key['sha3-384'] for key in json.loads(res.stdout.decode('utf-8'))}
+    signer = msu_gpgsign.AgentSigner(KEY_NAME, keys[KEY_NAME], gnupgHome=gnupgHome)
+    _checkAgainstSnapSign(signer, _assertion())
+    _checkAgainstSnapSign(signer, _serialsAssertion())
@@ -0,0 +1,168 @@
+"""
+Copyright (C) 2021 Canonical Ltd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License version 3 as
+published by the Free Software Foundation.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+The store clients against the local stand-in store of benchmarks/fakestore.py.
+
+    python3 -m pytest -q tests
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from urllib.parse import urljoin
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import fakestore  # noqa: E402
+import http_clients  # noqa: E402
+from xdg import BaseDirectory  # noqa: E402
+
+ACCOUNT = '/dev/api/account'
+REFRESH = '/api/v2/tokens/refresh'
+ACL = '/dev/api/acl/'
+
+
+def _store(monkeypatch, tmp_path, stale=False, **kwargs):
+    """Start a FakeStore and point the clients and their snapcraft.cfg at it."""
+    store = fakestore.FakeStore(**kwargs)
+    store.start()
+    for name, value in store.environ().items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setenv('STORE_JITTER', '0')
+    # xdg reads XDG_CONFIG_HOME once, when it is imported
+    monkeypatch.setattr(BaseDirectory, 'xdg_config_home', str(tmp_path))
+    (tmp_path / 'snapcraft').mkdir()
+    (tmp_path / 'snapcraft' / 'snapcraft.cfg').write_text(store.credentials(stale=stale))
+    return store
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    store = _store(monkeypatch, tmp_path)
+    yield store
+    store.stop()
+
+
+@pytest.fixture
+def staleStore(monkeypatch, tmp_path):
+    store = _store(monkeypatch, tmp_path, stale=True, latency=0.05)
+    yield store
+    store.stop()
+
+
+@pytest.fixture
+def limitedStore(monkeypatch, tmp_path):
+    # one request answered per second, then 429 with Retry-After: 1
+    store = _store(monkeypatch, tmp_path, faults=fakestore.Faults(rate_limit=1, paths=[ACCOUNT]))
+    yield store
+    store.stop()
+
+
+@pytest.fixture
+def unavailableStore(monkeypatch, tmp_path):
+    # every request gets a 503
+    store = _store(monkeypatch, tmp_path, faults=fakestore.Faults(burst_rate=1, burst_length=1))
+    monkeypatch.setenv('STORE_RETRIES', '2')
+    monkeypatch.setenv('STORE_BACKOFF', '0')
+    yield store
+    store.stop()
+
+
+def _account(store):
+    return urljoin(store.url, ACCOUNT)
+
+
+def _gather(client, url, count):
+    async def run():
+        async with client:
+            return await asyncio.gather(*(client.request('GET', url) for _ in range(count)))
+    return asyncio.run(run())
+
+
+def test_async_requests_share_one_refresh(staleStore):
+    client = http_clients.AsyncUbuntuOneAuthClient(pool_size=16)
+    responses = _gather(client, _account(staleStore), 32)
+    assert [r.status_code for r in responses] == [200] * 32
+    assert staleStore.requests['POST ' + REFRESH] == 1
+
+
+def test_threads_share_one_refresh(staleStore):
+    clients = [http_clients.UbuntuOneAuthClient() for _ in range(16)]
+    start = threading.Barrier(len(clients))
+    statuses = []
+
+    def run(client):
+        start.wait()
+        statuses.append(client.request('GET', _account(staleStore)).status_code)
+
+    threads = [threading.Thread(target=run, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert statuses == [200] * 16
+    assert staleStore.requests['POST ' + REFRESH] == 1
+
+
+def test_async_waits_retry_after(limitedStore):
+    client = http_clients.AsyncUbuntuOneAuthClient()
+    start = time.monotonic()
+    responses = _gather(client, _account(limitedStore), 2)
+    assert [r.status_code for r in responses] == [200, 200]
+    assert limitedStore.responses['GET {} 429'.format(ACCOUNT)] >= 1
+    assert time.monotonic() - start >= 0.9
+
+
+def test_blocking_waits_retry_after(limitedStore):
+    client = http_clients.UbuntuOneAuthClient()
+    start = time.monotonic()
+    statuses = [client.request('GET', _account(limitedStore)).status_code for _ in range(2)]
+    assert statuses == [200, 200]
+    assert limitedStore.responses['GET {} 429'.format(ACCOUNT)] >= 1
+    assert time.monotonic() - start >= 0.9
+
+
+def test_async_pool_limit(store):
+    # each connection is kept alive, so its client port names it
+    peers = set()
+    account = store.routes[('GET', ACCOUNT)]
+
+    def route(handler, body):
+        peers.add(handler.client_address)
+        time.sleep(0.02)
+        return account(handler, body)
+
+    store.routes[('GET', ACCOUNT)] = route
+    client = http_clients.AsyncUbuntuOneAuthClient(pool_size=3)
+    responses = _gather(client, _account(store), 30)
+    assert [r.status_code for r in responses] == [200] * 30
+    assert 1 <= len(peers) <= 3
+
+
+def test_async_retries_only_idempotent_methods(unavailableStore):
+    async def run():
+        async with http_clients.AsyncUbuntuOneAuthClient() as client:
+            for method, path in (('GET', ACCOUNT), ('POST', ACL)):
+                with pytest.raises(http_clients.errors.StoreServerError):
+                    await client.request(method, urljoin(unavailableStore.url, path))
+    asyncio.run(run())
+    assert unavailableStore.requests['GET ' + ACCOUNT] == 3
+    assert unavailableStore.requests['POST ' + ACL] == 1